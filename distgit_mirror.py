@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Local mirror of dist-git repositories.
+
+Every package is a shallow (depth 1), blob-filtered clone with sparse
+checkout of tests/ and gating.yaml only. Next runs update it with
+`git fetch`, which transfers only what changed since the last run.
+"""
+
+import os
+import shutil
+import subprocess
+
+DIST_GIT_URL = 'https://src.fedoraproject.org/'
+
+# Paths checked out from every repo.
+SPARSE_PATHS = ('/tests/', '/gating.yaml')
+
+
+def git(args, cwd=None):
+    """Run git command.
+
+    Returns
+    -------
+    tuple
+        (exit code, stdout)
+    """
+    proc = subprocess.Popen(['git'] + list(args), cwd=cwd,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    return proc.returncode, out.decode('utf-8', 'replace')
+
+
+class DistGitMirror(object):
+    """Sparse shallow clones of dist-git repos under one directory.
+
+    Parameters
+    ----------
+    path : str
+        Mirror directory, one sub-directory per package.
+    base_url : str
+        Dist-git URL.
+    branch : str
+        Branch to mirror.
+    """
+
+    def __init__(self, path, base_url=DIST_GIT_URL, branch='master'):
+        self.path = path
+        self.base_url = base_url
+        self.branch = branch
+        self.synced = set()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def repo_dir(self, pkg):
+        return os.path.join(self.path, pkg)
+
+    def repo_url(self, pkg):
+        return self.base_url + 'rpms/' + pkg + '.git'
+
+    def _clone(self, pkg):
+        repo = self.repo_dir(pkg)
+        shutil.rmtree(repo, ignore_errors=True)
+        code, _ = git(['clone', '--quiet', '--depth', '1', '--no-checkout',
+                       '--filter=blob:none', '--branch', self.branch,
+                       self.repo_url(pkg), repo])
+        if code != 0:
+            shutil.rmtree(repo, ignore_errors=True)
+            return False
+        git(['config', 'core.sparseCheckout', 'true'], cwd=repo)
+        sparse_file = os.path.join(repo, '.git', 'info', 'sparse-checkout')
+        if not os.path.isdir(os.path.dirname(sparse_file)):
+            os.makedirs(os.path.dirname(sparse_file))
+        with open(sparse_file, 'w') as sparse:
+            sparse.write('\n'.join(SPARSE_PATHS) + '\n')
+        code, _ = git(['checkout', '--quiet', self.branch], cwd=repo)
+        return code == 0
+
+    def _fetch(self, pkg):
+        repo = self.repo_dir(pkg)
+        code, _ = git(['fetch', '--quiet', '--depth', '1', 'origin',
+                       self.branch], cwd=repo)
+        if code != 0:
+            return False
+        code, _ = git(['reset', '--quiet', '--hard', 'FETCH_HEAD'], cwd=repo)
+        return code == 0
+
+    def sync(self, pkg):
+        """Clone package repo or update existing clone.
+
+        Returns
+        -------
+        bool
+            True if local copy is up to date.
+        """
+        if os.path.isdir(os.path.join(self.repo_dir(pkg), '.git')):
+            done = self._fetch(pkg) or self._clone(pkg)
+        else:
+            done = self._clone(pkg)
+        if done:
+            self.synced.add(pkg)
+        return done
+
+    def has(self, pkg):
+        """True if package was synced in this run."""
+        return pkg in self.synced
+
+    def exists(self, pkg, path):
+        """Checks if file exists in package repo."""
+        return os.path.isfile(os.path.join(self.repo_dir(pkg), path))
+
+    def read(self, pkg, path):
+        """Returns file content from package repo or None."""
+        path = os.path.normpath(path)
+        if path.startswith(os.pardir) or os.path.isabs(path):
+            return None
+        fname = os.path.join(self.repo_dir(pkg), path)
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'rb') as file_in:
+            return file_in.read().decode('utf-8', 'replace')
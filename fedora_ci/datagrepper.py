@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Fetch datagrepper messages of many topics concurrently.
+
+The first page of every topic tells number of pages, the remaining pages
+of all topics are fetched together by a thread pool. A failed page is
+retried on its own, other pages are kept. Fetched pages can be saved to
+a checkpoint file, an interrupted fetch is resumed from it.
+
+The time window (start, end) is fixed when fetch begins, so pages do not
+shift while they are being fetched or between fetch and resume.
+"""
+
+import os
+import json
+import time
+import threading
+import webclient
+from multiprocessing.pool import ThreadPool
+
+DATAGREPPER_URL = "https://apps.fedoraproject.org/datagrepper/raw"
+DEFAULT_JOBS = 8
+DEFAULT_PAGE_RETRIES = 3
+# Datagrepper maximum.
+ROWS_PER_PAGE = 100
+# Older checkpoint is not resumed, its window is too far in the past.
+MAX_CHECKPOINT_AGE = 3600
+# Checkpoint is saved after this number of fetched pages.
+CHECKPOINT_EVERY = 20
+
+
+class PageFetcher(object):
+    """Fetches messages of topics from the last delta seconds.
+
+    Parameters
+    ----------
+    delta : int
+        Length of time window in seconds.
+    jobs : int
+        Number of pages fetched at the same time.
+    retries : int
+        How many times a failed page is fetched again.
+    checkpoint : str
+        File to save fetched pages to, and to resume from.
+    query : function
+        query(url) returns response text or None, for tests.
+    """
+
+    def __init__(self, delta, jobs=DEFAULT_JOBS, retries=DEFAULT_PAGE_RETRIES,
+                 checkpoint=None, query=webclient.query_text):
+        self.delta = int(delta)
+        self.jobs = max(1, jobs)
+        self.retries = retries
+        self.checkpoint = checkpoint
+        self.query = query
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.unsaved = 0
+        self.state = None
+        self.end = None
+
+    def _new_state(self, start):
+        end = int(time.time())
+        if start is None:
+            start = end - self.delta
+        return {'start': int(start), 'end': end, 'pages': {}, 'page_count': {}}
+
+    def _load_state(self, start):
+        if self.checkpoint and os.path.isfile(self.checkpoint):
+            try:
+                with open(self.checkpoint) as state_in:
+                    state = json.load(state_in)
+                if start is None:
+                    covered = state['end'] - state['start'] == self.delta
+                else:
+                    covered = state['start'] <= start
+                if covered and time.time() - state['end'] < MAX_CHECKPOINT_AGE:
+                    print("INFO: Resume datagrepper fetch from %s" % self.checkpoint)
+                    return state
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        return self._new_state(start)
+
+    def save(self):
+        """Write fetched pages to checkpoint file."""
+        if not self.checkpoint:
+            return
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps(self.state)
+                self.unsaved = 0
+            tmp = self.checkpoint + '.tmp'
+            with open(tmp, 'w') as state_out:
+                state_out.write(data)
+            os.rename(tmp, self.checkpoint)
+
+    def url(self, topic, page):
+        return ("%s?topic=%s&start=%s&end=%s&page=%s&rows_per_page=%s" %
+                (DATAGREPPER_URL, topic, self.state['start'], self.state['end'],
+                 page, ROWS_PER_PAGE))
+
+    def fetch_page(self, task):
+        """Fetch one page of topic, retried on failure.
+
+        Returns
+        -------
+        bool
+            True if page is fetched.
+        """
+        topic, page = task
+        with self.lock:
+            if str(page) in self.state['pages'].get(topic, {}):
+                return True
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            result = self.query(self.url(topic, page))
+            if not result:
+                continue
+            try:
+                jresult = json.loads(result)
+                messages = jresult['raw_messages']
+                pages = int(jresult['pages'])
+            except (ValueError, KeyError, TypeError):
+                continue
+            with self.lock:
+                self.state['pages'].setdefault(topic, {})[str(page)] = messages
+                self.state['page_count'].setdefault(topic, pages)
+                self.unsaved += 1
+                save = self.unsaved >= CHECKPOINT_EVERY
+            if save:
+                self.save()
+            return True
+        print("FAIL: Could not get page %s of topic %s" % (page, topic))
+        return False
+
+    def complete(self, topic):
+        """True if all pages of topic are fetched."""
+        pages = self.state['pages'].get(topic, {})
+        count = self.state['page_count'].get(topic)
+        return count is not None and all(str(page) in pages for page in range(1, count + 1))
+
+    def fetch(self, topics, start=None):
+        """Fetch all messages of topics.
+
+        Parameters
+        ----------
+        topics : list
+            Topics to fetch.
+        start : float
+            Fetch messages since this time instead of the last delta
+            seconds. End of the fetched window is in self.end.
+
+        Returns
+        -------
+        dict
+            {topic: list of messages}, None for topics with a page which
+            could not be fetched.
+        """
+        self.state = self._load_state(start)
+        self.end = self.state['end']
+        pool = ThreadPool(self.jobs)
+        try:
+            pool.map(self.fetch_page, [(topic, 1) for topic in topics], chunksize=1)
+            tasks = [(topic, page) for topic in topics if topic in self.state['page_count']
+                     for page in range(2, self.state['page_count'][topic] + 1)]
+            pool.map(self.fetch_page, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        result = {}
+        for topic in topics:
+            if not self.complete(topic):
+                result[topic] = None
+                continue
+            result[topic] = []
+            for page in range(1, self.state['page_count'][topic] + 1):
+                result[topic].extend(self.state['pages'][topic][str(page)])
+        # Checkpoint may have pages of other topics from interrupted fetch.
+        if all(self.complete(topic) for topic in set(topics) | set(self.state['pages'])):
+            if self.checkpoint and os.path.isfile(self.checkpoint):
+                os.remove(self.checkpoint)
+        else:
+            self.save()
+        return result
@@ -8,10 +8,27 @@ import time
 import os
 import re
 import requests
+import subprocess
 import sys
+import threading
 import yaml
-
-# This file chekcs ansible tags. standard-test-roles RPM should be installed.
+from multiprocessing.pool import ThreadPool
+
+# webclient, testtags and repocache are in the repository root, and
+# jenkins, datagrepper and pipeline_tracker here import webclient from it.
+# The root goes last, so stat.py there does not shadow the standard stat.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import webclient
+import testtags
+import repocache
+import pipeline_tracker
+import datagrepper
+import message_archive
+import jenkins
+from topic_store import TopicStore
+
+# This file checks ansible tags. Tags are found by parsing playbooks, ansible
+# is needed only with --verify-tags. standard-test-roles RPM should be installed.
 
 requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
@@ -20,7 +37,7 @@ This scripts checks if Fedora CI pipeline executes correctly and branch has test
 """
 
 
-JENKINS_URL = "https://jenkins-continuous-infra.apps.ci.centos.org"
+JENKINS_URL = jenkins.JENKINS_URL
 DATAGREPPER_URL = "https://apps.fedoraproject.org/datagrepper/raw"
 
 GIT_COMMIT_TOPIC = "org.fedoraproject.prod.git.receive"
@@ -71,17 +88,84 @@ TEST_FAILURE = 2
 SKIP = 3
 RUNNING = 4
 
+# Check in-process tags analysis with ansible-playbook --list-tags
+VERIFY_TAGS = False
+
+# Messages verified at the same time
+DEFAULT_JOBS = 8
+
+# Local dist-git repos, see get_repo_cache()
+repo_cache = None
+REPO_CACHE_DIR = repocache.DEFAULT_CACHE_DIR
+REPO_CACHE_SIZE = repocache.DEFAULT_CACHE_SIZE
+
+
+def get_repo_cache():
+    global repo_cache
+    if repo_cache is None:
+        repo_cache = repocache.RepoCache(REPO_CACHE_DIR, max_size=REPO_CACHE_SIZE)
+    return repo_cache
+
+# Jenkins API client, see get_jenkins()
+jenkins_client = None
+JENKINS_CACHE = None
+# Polls running Jenkins builds, see get_build_watcher()
+build_watcher = None
+# Seconds to wait for a running Jenkins build
+JENKINS_BUILD_WAIT = 5 * 60
+_jenkins_lock = threading.Lock()
+
+
+def get_jenkins():
+    global jenkins_client
+    with _jenkins_lock:
+        if jenkins_client is None:
+            jenkins_client = jenkins.JenkinsClient(JENKINS_URL, cache=JENKINS_CACHE)
+        return jenkins_client
+
+
+def get_build_watcher():
+    global build_watcher
+    client = get_jenkins()
+    with _jenkins_lock:
+        if build_watcher is None:
+            build_watcher = jenkins.BuildWatcher(client)
+        return build_watcher
+
 
-def _query_url(url):
+def ansible_list_tags(tests_dir):
+    """
+    Task tags reported by ansible-playbook --list-tags, None if it failed
+    """
     try:
-        resp = requests.get(url, verify=False)
-    except Exception as e:
-        print("FAIL: Could not connect to %s" % url)
-        print("Exception: %s" % e)
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(['ansible-playbook', '--list-tags', 'tests.yml'], cwd=tests_dir,
+                                    stdout=subprocess.PIPE, stderr=devnull)
+            out, _ = proc.communicate()
+    except OSError:
         return None
-    if resp.status_code < 200 or resp.status_code >= 300:
+    if proc.returncode != 0:
         return None
-    return resp.text
+    tags = set()
+    for task_tags in re.findall(r"TASK TAGS: \[(.*)\]", out.decode('utf-8', 'replace')):
+        tags.update(tag.strip() for tag in task_tags.split(','))
+    return tags
+
+
+def runs_on_classic(tests_dir):
+    """
+    Check if tests.yml in tests_dir has classic tag
+    """
+    tags = testtags.dir_tags(tests_dir)
+    classic = 'classic' in (tags or [])
+    if VERIFY_TAGS:
+        ansible_tags = ansible_list_tags(tests_dir)
+        if ansible_tags is None:
+            print("WARN: ansible-playbook --list-tags failed in %s" % tests_dir)
+        elif ('classic' in ansible_tags) != classic:
+            print("WARN: %s: parsed tags %s, ansible tags %s" % (tests_dir, tags, sorted(ansible_tags)))
+            classic = 'classic' in ansible_tags
+    return classic
 
 
 def check_tests(project, branch="master", pr=None):
@@ -97,32 +181,15 @@ def check_tests(project, branch="master", pr=None):
     repo = "https://src.fedoraproject.org/rpms/%s" % project
     if not pr:
         url = "%s/raw/%s/f/tests/tests.yml" % (repo, branch)
-        if not _query_url(url):
+        if not webclient.query_text(url):
             return False
 
-    os.system('rm -rf %s' % project)
-    os.system("git clone -b %s --single-branch %s" % (branch, repo))
-#    os.system("cd %s && git checkout %s" % (project, branch))
-
-    if pr:
-        # apply the PR before checking if tests exist as PR could add tests
-        os.system("curl https://src.fedoraproject.org/rpms/%s/pull-request/%s.patch > %s.patch" % (project, pr, pr))
-        os.system("cd %s && git apply ../%s.patch" % (project, pr))
-        os.system("rm -rf %s & rm -f %s" % (project, pr))
-
-    if os.system("test -d %s/tests" % project) != 0:
-        os.system("rm -rf %s & rm -f %s" % (project, pr))
-        return False
-
-    # Make sure test on branch can run on classic
-    check_classic = 'ansible-playbook --list-tags tests.yml 2> /dev/null | grep -e "TASK TAGS: \[.*\\<classic\\>.*\]"'
-    cmd = "cd %s/tests && %s" % (project, check_classic)
-    has_tests = False
-    if os.system(cmd) == 0:
-        has_tests = True
-    os.system('rm -rf %s' % project)
-
-    return has_tests
+    # PR is applied before checking if tests exist as PR could add tests
+    with get_repo_cache().tests(project, branch, pr) as tests_dir:
+        if not tests_dir:
+            return False
+        # Make sure test on branch can run on classic
+        return runs_on_classic(tests_dir)
 
 def has_jenkins_pipeline(pipeline_type, branch):
     """
@@ -132,75 +199,75 @@ def has_jenkins_pipeline(pipeline_type, branch):
         branch = "rawhide"
 
     pipeline = PIPELINES[pipeline_type] % branch
-    jenkins_query = "%s/view/all/job/%s/api/json?pretty=true" % (JENKINS_URL, pipeline)
-    result = _query_url(jenkins_query)
-    if not result:
-        return False
-    return True
-
+    return get_jenkins().job_exists(pipeline)
 
-def get_jenkins_build_info(pipeline_type, branch, build_id):
-    if branch == "master":
-        branch = "rawhide"
 
-    pipeline = PIPELINES[pipeline_type] % branch
-    jenkins_query = "%s/view/all/job/%s/%s/api/json?pretty=true" % (JENKINS_URL, pipeline, build_id)
-    result = _query_url(jenkins_query)
-    if not result:
-        return None
-
-    jresult = json.loads(result)
-    return jresult
-
-
-def get_jenkins_build(project, branch, commit_id):
+def get_jenkins_build(pipeline_type, project, branch, commit_id):
     """
-    Checks if there is a Jenkins build on proper Jenkins pipeline
+    Find Jenkins build started by message for project, branch and commit_id
+    (PR id or koji task id), None if there is no such build
     """
+    print("INFO: Checking if tests there is build in Jenkins for %s %s %s" % (project, branch, commit_id))
 
+    # Messages have branch as in dist-git, only pipeline name uses rawhide
+    pipeline = PIPELINES[pipeline_type] % ("rawhide" if branch == "master" else branch)
+    return get_jenkins().find_build(pipeline, project, branch, commit_id)
+
+
+def get_jenkins_build_url(pipeline_type, branch, build_id):
     if branch == "master":
         branch = "rawhide"
 
-    print("INFO: Checking if tests there is build in Jenkins for %s %s %s" % (project, branch, commit_id))
-
     pipeline = PIPELINES[pipeline_type] % branch
-    jenkins_query = "%s/view/all/job/%s/api/json?pretty=true" % (JENKINS_URL, pipeline)
-    result = _query_url(jenkins_query)
-    if not result:
-        return None
+    return get_jenkins().build_url(pipeline, build_id)
 
-    jresult = json.loads(result)
-    builds = jresult['builds']
-    if not builds:
-        return None
 
-    for build in builds:
-        message_url = ("%s/view/all/job/%s/%s/artifact/messages/message-audit.json" %
-                    (JENKINS_URL, pipeline, build['number']))
-        result = _query_url(message_url)
-        if not result:
-            return None
+def steps_status(step_results):
+    """
+    Status of the first failed step, RUNNING if some step did not finish
+    """
+    status = PASS
+    for result in step_results:
+        # Set the status of first failure
+        if result['status'] == INFRA_FAILURE or result['status'] == TEST_FAILURE:
+            return result['status']
+        if result['status'] == RUNNING:
+            status = RUNNING
+    return status
 
-        build_msgs = json.loads(result)
-        for b_msg in build_msgs:
-            msg = json.loads(build_msgs[b_msg])
-            msg_repo = msg['repo']
-            msg_branch = msg['branch']
-            msg_rev = msg['rev']
 
-            if msg_repo == project and msg_branch == branch and msg_rev == commit_id:
-                return int(build['number'])
+class WaitBudget(object):
+    """
+    Time all verifications running together may spend waiting for pipelines
+    """
+    def __init__(self, seconds=None):
+        self.deadline = None
+        if seconds is not None:
+            self.deadline = time.time() + seconds
 
-    return None
 
 class Monitor:
 
-    def __init__(self):
+    def __init__(self, fetch_jobs=datagrepper.DEFAULT_JOBS, checkpoint=None, archive=None):
         # Check datagrepper messages from the last 24 hours
         self.delta = os.getenv("DELTA", 24*3600)
         # By default we wait for running builds on pipeline to complete
         self.wait_complete = True
-        self.queried_topics = {}
+        # Datagrepper pages fetched at the same time and checkpoint to resume from
+        self.fetch_jobs = fetch_jobs
+        self.checkpoint = checkpoint
+        # End of the time window of the last datagrepper fetch
+        self.fetched_end = None
+        # Messages kept between runs, only new ones are fetched
+        self.archive = None
+        if archive:
+            self.archive = message_archive.MessageArchive(archive)
+        # Shared by all verifications, see set_wait_budget()
+        self.budget = WaitBudget()
+        # Messages of queried topics, indexed by (repo, branch, rev)
+        self.queried_topics = TopicStore()
+        # Pipelines state from VALID_PIPELINE_TOPICS messages
+        self.tracker = pipeline_tracker.PipelineTracker(VALID_PIPELINE_TOPICS, self.queried_topics)
         self.pipeline_steps = {}
 
         valid_status = {"SUCCESS": PASS, "FAILURE": INFRA_FAILURE, "UNSTABLE" : TEST_FAILURE}
@@ -231,38 +298,96 @@ class Monitor:
     def set_wait_complete(self, value):
         self.wait_complete = value
 
-    def _query_datagrepper(self, topic):
-        page=1
-        pages=9999
-        data = []
+    def set_wait_budget(self, seconds):
+        self.budget = WaitBudget(seconds)
+
+    def wait_jenkins_build(self, pipeline_type, branch, build_id):
+        """
+        Wait for Jenkins build to finish, other verifications keep running.
+        Returns build info, still building if it did not finish in time,
+        or None if there is no info about the build
+        """
+        if branch == "master":
+            branch = "rawhide"
+        deadline = time.time() + JENKINS_BUILD_WAIT
+        if self.budget.deadline is not None:
+            deadline = min(deadline, self.budget.deadline)
+        pipeline = PIPELINES[pipeline_type] % branch
+        return get_build_watcher().wait(pipeline, build_id, deadline)
+
+    def max_pipeline_wait(self):
+        """
+        Seconds the longest pipeline may be waited for, with Jenkins build
+        """
+        return max(sum(step["timeout"] for step in steps) * 60 + 5 * 60
+                   for steps in self.pipeline_steps.values())
+
+    def _query_topics(self, topics):
+        """
+        Get messages of topics from datagrepper, pages are fetched concurrently
+        """
+        fetcher = datagrepper.PageFetcher(self.delta, jobs=self.fetch_jobs,
+                                          checkpoint=self.checkpoint)
+        if self.archive is None:
+            result = fetcher.fetch(topics)
+        else:
+            result = self._query_archived_topics(fetcher, topics)
+        self.fetched_end = fetcher.end
+        with self.tracker.cond:
+            for topic, data in result.items():
+                if data is not None:
+                    self.queried_topics.set_topic(topic, data)
+            self.tracker.cond.notify_all()
+        return result
+
+    def _query_archived_topics(self, fetcher, topics):
+        """
+        Fetch only messages newer than the archive has, serve topics from the archive
+        """
+        window_start = time.time() - int(self.delta)
+        start = min(self.archive.refresh_start(topic, window_start) for topic in topics)
+        fetched = fetcher.fetch(topics, start)
+        result = {}
+        for topic in topics:
+            if fetched[topic] is None:
+                result[topic] = None
+                continue
+            self.archive.add(topic, fetched[topic], fetcher.end)
+        pruned = self.archive.prune(window_start)
+        for topic in topics:
+            if topic not in result:
+                result[topic] = self.archive.messages(topic, window_start)
+        print("INFO: Fetched %s new messages since %s, removed %s old messages from archive" %
+              (sum(len(data) for data in fetched.values() if data), int(start), pruned))
+        return result
 
-        if topic in self.queried_topics and not self.wait_complete:
+    def _query_datagrepper(self, topic):
+        if self.queried_topics.has_topic(topic) and not self.wait_complete:
             # In this case we do not need to update the data from the topic
             # We are processing many messages and we want the messages from the beging,
             # otherwise some topics not be in specific delta any more
-            return self.queried_topics[topic]
-
-        while page <= pages:
-            url = "%s?topic=%s&delta=%s&page=%s" % (DATAGREPPER_URL, topic, self.delta, page)
-            result = _query_url("%s&page=%s" % (url, page))
-            if not result:
-                return None
-
-            jresult = json.loads(result)
-            data.extend(jresult['raw_messages'])
+            return self.queried_topics.topic(topic)
 
-            pages = int(jresult['pages'])
-            page += 1
-
-        self.queried_topics[topic] = data
-        return data
+        return self._query_topics([topic])[topic]
 
     def query_all_topics(self):
         print("INFO: Querying topics from all pipelines...")
-        for topic in VALID_PIPELINE_TOPICS:
-            self._query_datagrepper(topic)
+        self._query_topics(VALID_PIPELINE_TOPICS)
         print("INFO: All topics queried")
 
+    def follow_pipelines(self, bus=None):
+        """
+        Load pipeline messages from the last delta seconds and keep
+        following new ones, waiters are woken up when a message arrives.
+        Messages are taken from bus if it is given, e.g. FakeBus in tests
+        """
+        if bus is None:
+            self.query_all_topics()
+            # Continue where the fetch ended, it can take minutes
+            start = self.fetched_end - pipeline_tracker.FOLLOW_OVERLAP
+            bus = pipeline_tracker.DatagrepperBus(VALID_PIPELINE_TOPICS, start)
+        self.tracker.follow(bus)
+
 
     def get_recent_prs(self, namespace="rpms"):
         """
@@ -322,94 +447,30 @@ class Monitor:
         return builds
 
 
-    def get_pr_topic(self, project, branch, pr_id, topic, timeout):
+    def _topic_deadline(self, timeout):
         """
-        Check datagrepper for specific topic related to the PR
+        When to stop waiting for a topic, timeout is in minutes
         """
-        count = 0
-        topic_msg = None
-        if not self.wait_complete:
-            timeout = 0
-        while not topic_msg:
-            if count > timeout:
-                return None
-
-            count += 1
-            # print("INFO: Searching topic %s for %s %s %s (%s / %s)" % (topic, project, branch, pr_id, count, timeout))
-            data = self._query_datagrepper(topic)
-            if not data:
-                # Check if pipeline completed without sending expected topic message
-                if topic != PR_PIPELINE_COMPLETE_TOPIC:
-                    if self.get_pr_topic(project, branch, pr_id, PR_PIPELINE_COMPLETE_TOPIC, 0):
-                        print("FAIL: pileline completed, but topic %s was never sent" % topic)
-                        return None
-                if count <= timeout:
-                    time.sleep(60)
-                continue
-            for info in data:
-                msg = info['msg']
-                msg_repo = msg['repo']
-                msg_branch = msg['branch']
-                msg_rev = msg['rev'].replace("PR-", "")
-                if msg_repo == project and msg_branch == branch and msg_rev == pr_id:
-                    topic_msg = info
-                    return info
-
-            # Check if pipeline completed without sending expected topic message
-            if topic != PR_PIPELINE_COMPLETE_TOPIC:
-                if self.get_pr_topic(project, branch, pr_id, PR_PIPELINE_COMPLETE_TOPIC, 0):
-                    print("FAIL: pileline completed, but topic %s was never sent" % topic)
-                    return None
-
-            if count <= timeout:
-                time.sleep(60)
+        if not self.wait_complete or not timeout:
+            return None
+        deadline = time.time() + timeout * 60
+        if self.budget.deadline is not None:
+            deadline = min(deadline, self.budget.deadline)
+        return deadline
 
-        return None
+    def get_pr_topic(self, project, branch, pr_id, topic, timeout):
+        """
+        Wait for specific topic related to the PR
+        """
+        return self.tracker.wait((project, branch, pr_id), topic, self._topic_deadline(timeout),
+                                 complete_topic=PR_PIPELINE_COMPLETE_TOPIC)
 
     def get_build_topic(self, project, branch, task_id, topic, timeout):
         """
-        Check datagrepper for specific topic related to the koji build
+        Wait for specific topic related to the koji build
         """
-        count = 0
-        topic_msg = None
-        if not self.wait_complete:
-            timeout = 0
-        while not topic_msg:
-            if count > timeout:
-                return None
-
-            count += 1
-            # print("INFO: Searching topic %s for %s %s %s (%s / %s)" % (topic, project, branch, commit_id, count, timeout))
-            data = self._query_datagrepper(topic)
-            if not data:
-                # Check if pipeline completed withtout sending expected topic message
-                if topic != BUILD_PIPELINE_COMPLETE_TOPIC:
-                    if self.get_build_topic(project, branch, task_id, BUILD_PIPELINE_COMPLETE_TOPIC, 0):
-                        print("FAIL: pileline completed, but topic %s was never sent" % topic)
-                        return None
-                if count <= timeout:
-                    time.sleep(60)
-                continue
-
-            for info in data:
-                msg = info['msg']
-                msg_repo = msg['repo']
-                msg_branch = msg['branch']
-                msg_id = msg['rev'].replace("kojitask-", "")
-                if msg_repo == project and msg_branch == branch and msg_id == task_id:
-                    topic_msg = info
-                    return info
-
-            # Check if pipeline completed without sending expected topic message
-            if topic != BUILD_PIPELINE_COMPLETE_TOPIC:
-                if self.get_build_topic(project, branch, task_id, BUILD_PIPELINE_COMPLETE_TOPIC, 0):
-                    print("FAIL: pileline completed, but topic %s was never sent" % topic)
-                    return None
-
-            if count <= timeout:
-                time.sleep(60)
-
-        return None
+        return self.tracker.wait((project, branch, task_id), topic, self._topic_deadline(timeout),
+                                 complete_topic=BUILD_PIPELINE_COMPLETE_TOPIC)
 
     def verify_pull_request(self, project, branch, pr_id):
         """
@@ -495,19 +556,20 @@ class Monitor:
                 topic_jenkins_build_url = topic_msg['msg']['build_url']
 
 
+        if not topic_jenkins_build:
+            # No message with build_id, find the build by message which started it
+            topic_jenkins_build = get_jenkins_build("pr", project, branch, pr_id)
+            if topic_jenkins_build:
+                topic_jenkins_build_url = get_jenkins_build_url("pr", branch, topic_jenkins_build)
         if topic_jenkins_build:
             # Wait some time for jenkins build be completed
-            build_info = get_jenkins_build_info("pr", branch, topic_jenkins_build)
-            count = 5
-            while build_info['building'] and count > 0:
-                build_info = get_jenkins_build_info("pr", branch, topic_jenkins_build)
-                time.sleep(60)
-                count -= 1
-
-            if count == 0:
-                print("FAIL: Jenkins build did not finish: %s" % build_info)
-                status = INFRA_FAILURE
+            build_info = self.wait_jenkins_build("pr", branch, topic_jenkins_build)
+            if build_info is None:
+                print("FAIL: Could not get Jenkins build %s" % topic_jenkins_build_url)
                 step_results.append({'step': "Jenkins build complete", 'status': INFRA_FAILURE})
+            elif build_info['building']:
+                print("SKIP: Jenkins build still running: %s" % topic_jenkins_build_url)
+                step_results.append({'step': "Jenkins build complete", 'status': RUNNING})
             else:
                 step_results.append({'step': "Jenkins build complete", 'status': PASS})
             print("INFO: Jenkins build URL: %s" % topic_jenkins_build_url)
@@ -517,12 +579,7 @@ class Monitor:
             step_results.append({'step': "Find Jenkins build", 'status': INFRA_FAILURE})
 
         pr_result["steps"] = step_results
-        pr_result["status"] = PASS
-        for result in step_results:
-            # Set the status of first failure
-            if result['status'] == INFRA_FAILURE or result['status'] == TEST_FAILURE:
-                pr_result["status"] = result['status']
-                break
+        pr_result["status"] = steps_status(step_results)
 
         return pr_result
 
@@ -610,19 +667,20 @@ class Monitor:
                 topic_jenkins_build_url = topic_msg['msg']['build_url']
 
 
+        if not topic_jenkins_build:
+            # No message with build_id, find the build by message which started it
+            topic_jenkins_build = get_jenkins_build("kojibuild", project, branch, task_id)
+            if topic_jenkins_build:
+                topic_jenkins_build_url = get_jenkins_build_url("kojibuild", branch, topic_jenkins_build)
         if topic_jenkins_build:
             # Wait some time for jenkins build be completed
-            build_info = get_jenkins_build_info("kojibuild", branch, topic_jenkins_build)
-            count = 5
-            while build_info['building'] and count > 0:
-                build_info = get_jenkins_build_info("kojibuild", branch, topic_jenkins_build)
-                time.sleep(60)
-                count -= 1
-
-            if count == 0:
-                print("FAIL: Jenkins build did not finish: %s" % build_info)
-                status = INFRA_FAILURE
+            build_info = self.wait_jenkins_build("kojibuild", branch, topic_jenkins_build)
+            if build_info is None:
+                print("FAIL: Could not get Jenkins build %s" % topic_jenkins_build_url)
                 step_results.append({'step': "Jenkins build complete", 'status': INFRA_FAILURE})
+            elif build_info['building']:
+                print("SKIP: Jenkins build still running: %s" % topic_jenkins_build_url)
+                step_results.append({'step': "Jenkins build complete", 'status': RUNNING})
             else:
                 step_results.append({'step': "Jenkins build complete", 'status': PASS})
             print("INFO: Jenkins build URL: %s" % topic_jenkins_build_url)
@@ -632,12 +690,7 @@ class Monitor:
             step_results.append({'step': "Find Jenkins build", 'status': INFRA_FAILURE})
 
         build_result["steps"] = step_results
-        build_result["status"] = PASS
-        for result in step_results:
-            # Set the status of first failure
-            if result['status'] == INFRA_FAILURE or result['status'] == TEST_FAILURE:
-                build_result["status"] = result['status']
-                break
+        build_result["status"] = steps_status(step_results)
 
         return build_result
 
@@ -645,16 +698,46 @@ class Monitor:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('-p', '--pipeline', dest='pipeline', choices=PIPELINES.keys(), default=None)
+    parser.add_argument('--verify-tags', dest='verify_tags', action='store_true',
+                        help='check parsed test tags with ansible-playbook --list-tags')
+    parser.add_argument('--repo-cache', dest='repo_cache', default=repocache.DEFAULT_CACHE_DIR,
+                        help='directory with cached dist-git repos, default: %(default)s')
+    parser.add_argument('--repo-cache-size', dest='repo_cache_size', type=int,
+                        default=repocache.DEFAULT_CACHE_SIZE // 2**20,
+                        help='disk budget of repo cache in MB, default: %(default)s')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=DEFAULT_JOBS,
+                        help='number of messages verified at the same time, default: %(default)s')
+    parser.add_argument('--fetch-jobs', dest='fetch_jobs', type=int, default=datagrepper.DEFAULT_JOBS,
+                        help='number of datagrepper pages fetched at the same time, default: %(default)s')
+    parser.add_argument('--wait-budget', dest='wait_budget', type=int, default=None,
+                        help='minutes all verifications together may wait for pipelines, '
+                             'default: time of the longest pipeline')
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None,
+                        help='file to save datagrepper pages to, interrupted fetch is resumed from it')
+    parser.add_argument('--jenkins-cache', dest='jenkins_cache', default=None,
+                        help='JSON file with finished Jenkins builds kept between runs')
+    parser.add_argument('--archive', dest='archive', default=None,
+                        help='SQLite file with messages kept between runs, only new messages are fetched')
     args = parser.parse_args()
+    VERIFY_TAGS = args.verify_tags
+    REPO_CACHE_DIR = args.repo_cache
+    REPO_CACHE_SIZE = args.repo_cache_size * 2**20
+    JENKINS_CACHE = args.jenkins_cache
 
     start_time = int(time.time())
 
-    monitor = Monitor()
+    webclient.configure(pool_size=max(args.jobs, args.fetch_jobs, webclient.DEFAULT_POOL_SIZE))
+    monitor = Monitor(fetch_jobs=args.fetch_jobs, checkpoint=args.checkpoint, archive=args.archive)
+    if args.wait_budget is None:
+        monitor.set_wait_budget(monitor.max_pipeline_wait())
+    else:
+        monitor.set_wait_budget(args.wait_budget * 60)
 
     ci_message = os.getenv("CI_MESSAGE", None)
     if ci_message:
         msg = yaml.load(ci_message)
         messages = [msg]
+        monitor.follow_pipelines()
     else:
         if not args.pipeline:
             messages = []
@@ -676,6 +759,8 @@ if __name__ == "__main__":
 
     result_log = {"results" : []}
 
+    # (verify function, arguments) or (None, ready result) for every message
+    checks = []
     for message in messages:
         if 'pullrequest' in message:
             project = message['pullrequest']['project']['name']
@@ -688,8 +773,7 @@ if __name__ == "__main__":
             if message['pullrequest']['comments'] and "citest" not in message['pullrequest']['comments'][-1]['comment']:
                 print("SKIP: %s %s %s - Comment added to Pull request is not for rebuild" % (project, branch, pr_id))
                 continue
-            pr_result = monitor.verify_pull_request(project, branch, pr_id)
-            result_log["results"].append(pr_result)
+            checks.append((monitor.verify_pull_request, (project, branch, pr_id)))
         elif 'build_id' in message:
             project = message['name']
             if not message['request']:
@@ -702,15 +786,29 @@ if __name__ == "__main__":
                 print("FAIL: %s - could not find build tag for task %s" % (project, task_id))
                 build_result = {"project" : project, "branch" : branch, "task_id" : task_id,
                                 "status" : INFRA_FAILURE, "pipeline": "kojibuild"}
-                result_log["results"].append(build_result)
+                checks.append((None, build_result))
                 continue
             branch = re.sub("-.*", "", build_tag)
-            build_result = monitor.verify_kojibuild(project, branch, task_id)
-            result_log["results"].append(build_result)
+            checks.append((monitor.verify_kojibuild, (project, branch, task_id)))
         else:
             print("FAIL: Does not support ci_message: %s" % message)
             sys.exit(1)
 
+    def run_check(check):
+        verify, verify_args = check
+        if verify is None:
+            return verify_args
+        return verify(*verify_args)
+
+    # Verifications mostly wait for pipelines, run them together so the whole
+    # run takes about as long as the longest pipeline.
+    pool = ThreadPool(max(1, args.jobs))
+    try:
+        result_log["results"] = pool.map(run_check, checks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
     finish_time = int(time.time())
     result_log["start_time"] = start_time
     result_log["finish_time"] = finish_time
@@ -719,6 +817,13 @@ if __name__ == "__main__":
     with open('result.json', 'w') as resultfile:
         json.dump(result_log, resultfile, indent=4, sort_keys=True, separators=(',', ': '))
 
+    monitor.tracker.stop()
+    if jenkins_client is not None:
+        jenkins_client.save()
+        print("Jenkins: %(requests)s requests, %(cached)s builds from cache" % jenkins_client.stats)
+    if repo_cache is not None:
+        print("Repo cache: removed %s repos" % repo_cache.prune())
+
     status = PASS
     for result in result_log['results']:
         # Set the status of first failure or skip
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Jenkins JSON API client for the CI monitor.
+
+Queries ask only for needed fields with `tree=` and without pretty
+printing. Job existence is asked once per run. Finished builds never
+change, they are kept in a persistent cache file. Status of many builds
+of one job is read with one request.
+
+Running builds are waited for by BuildWatcher, which polls all of them
+together.
+
+Builds are found by (repo, branch, rev) of the message which started
+them. The messages are read from message-audit.json artifacts, every
+finished build is read once and kept in an index in the cache file.
+"""
+
+import os
+import json
+import time
+import threading
+import webclient
+from multiprocessing.pool import ThreadPool
+from topic_store import normalize_rev
+
+JENKINS_URL = "https://jenkins-continuous-infra.apps.ci.centos.org"
+# Build fields kept in cache and returned by build().
+BUILD_FIELDS = "number,building,result,url,timestamp,duration"
+# Audit artifacts read at the same time.
+AUDIT_JOBS = 8
+# Messages which started the build, relative to build artifacts.
+AUDIT_ARTIFACT = "messages/message-audit.json"
+
+
+class JenkinsClient(object):
+    """Jenkins API with per-run and persistent caches.
+
+    Parameters
+    ----------
+    url : str
+        Jenkins URL.
+    cache : str
+        JSON file with finished builds, kept between runs.
+    query : function
+        query(url) returns response text or None, for tests.
+    """
+
+    def __init__(self, url=JENKINS_URL, cache=None, query=webclient.query_text):
+        self.url = url
+        self.cache_file = cache
+        self.query = query
+        self.lock = threading.Lock()
+        # One index update at a time
+        self.audit_lock = threading.Lock()
+        # {job: True/False}, asked once per run
+        self.jobs = {}
+        # {job: {build number as str: build info}}, finished builds only
+        self.finished = {}
+        # {job: {'scanned': [build numbers], 'builds': {"repo branch rev": number}}}
+        self.audit = {}
+        self.stats = {'requests': 0, 'cached': 0}
+        if cache and os.path.isfile(cache):
+            try:
+                with open(cache) as cache_in:
+                    data = json.load(cache_in)
+                self.finished = data.get('builds', {})
+                self.audit = data.get('audit', {})
+            except (IOError, OSError, ValueError, AttributeError):
+                print("WARN: Could not read Jenkins cache %s" % cache)
+
+    def save(self):
+        """Write finished builds and audit index to cache file."""
+        if not self.cache_file:
+            return
+        with self.lock:
+            data = json.dumps({'builds': self.finished, 'audit': self.audit})
+        tmp = self.cache_file + '.tmp'
+        with open(tmp, 'w') as cache_out:
+            cache_out.write(data)
+        os.rename(tmp, self.cache_file)
+
+    def build_url(self, job, number):
+        return "%s/job/%s/%s/" % (self.url, job, number)
+
+    def api(self, path, tree):
+        """JSON of Jenkins object at path with fields in tree, None on error."""
+        url = "%s/view/all/%s/api/json?tree=%s" % (self.url, path, tree)
+        with self.lock:
+            self.stats['requests'] += 1
+        result = self.query(url)
+        if not result:
+            return None
+        try:
+            return json.loads(result)
+        except ValueError:
+            return None
+
+    def job_exists(self, job):
+        """Check if there is a job, asked once per run."""
+        with self.lock:
+            if job in self.jobs:
+                return self.jobs[job]
+        exists = self.api("job/%s" % job, "name") is not None
+        with self.lock:
+            self.jobs[job] = exists
+        return exists
+
+    def _cached(self, job, number):
+        with self.lock:
+            info = self.finished.get(job, {}).get(str(number))
+            if info is not None:
+                self.stats['cached'] += 1
+            return info
+
+    def _remember(self, job, info):
+        if info.get('building') or info.get('number') is None:
+            return
+        with self.lock:
+            self.finished.setdefault(job, {})[str(info['number'])] = info
+
+    def _forget_unlisted(self, job, listed):
+        with self.lock:
+            cached = self.finished.get(job, {})
+            for number in list(cached):
+                if int(number) not in listed:
+                    del cached[number]
+
+    def build(self, job, number):
+        """Info of one build, None if it could not be got."""
+        info = self._cached(job, number)
+        if info is not None:
+            return info
+        info = self.api("job/%s/%s" % (job, number), BUILD_FIELDS)
+        if info is not None:
+            self._remember(job, info)
+        return info
+
+    def builds(self, job, numbers):
+        """Info of many builds of a job.
+
+        Builds not in cache are read with one request for the job; builds
+        not listed there are asked one by one. Only the asked builds are
+        added to the cache, cached builds not listed any more are dropped.
+
+        Returns
+        -------
+        dict
+            {number: build info or None}
+        """
+        result = {}
+        missing = []
+        for number in numbers:
+            info = self._cached(job, number)
+            if info is None:
+                missing.append(number)
+            else:
+                result[number] = info
+        if missing:
+            jresult = self.api("job/%s" % job, "builds[%s]" % BUILD_FIELDS)
+            listed = {}
+            for info in (jresult or {}).get('builds') or []:
+                listed[info.get('number')] = info
+            if jresult is not None:
+                self._forget_unlisted(job, listed)
+            for number in missing:
+                info = listed.get(int(number))
+                if info is None:
+                    info = self.build(job, number)
+                else:
+                    self._remember(job, info)
+                result[number] = info
+        return result
+
+    def _has_audit(self, job, number):
+        """True/False if build has audit artifact, None if it is not known."""
+        info = self.api("job/%s/%s" % (job, number), "artifacts[relativePath]")
+        if info is None:
+            return None
+        return any(artifact.get('relativePath') == AUDIT_ARTIFACT
+                   for artifact in info.get('artifacts') or [])
+
+    def _read_audit(self, task):
+        """Index keys of messages in build audit artifact.
+
+        Returns
+        -------
+        list
+            Keys, empty if the build has no usable artifact. None if it
+            could not be read and should be tried again.
+        """
+        job, number = task
+        url = "%s/view/all/job/%s/%s/artifact/%s" % (self.url, job, number, AUDIT_ARTIFACT)
+        with self.lock:
+            self.stats['requests'] += 1
+        result = self.query(url)
+        if not result:
+            # Builds aborted early have no artifact, that is not an error.
+            if self._has_audit(job, number) is False:
+                return []
+            return None
+        keys = []
+        try:
+            for b_msg in json.loads(result).values():
+                msg = json.loads(b_msg) if not isinstance(b_msg, dict) else b_msg
+                keys.append(audit_key(msg['repo'], msg['branch'], msg['rev']))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            print("WARN: Could not parse %s" % url)
+            return []
+        return keys
+
+    def update_audit(self, job):
+        """Read audit artifacts of builds not in the index yet."""
+        jresult = self.api("job/%s" % job, "builds[number,building]")
+        if jresult is None:
+            return
+        with self.lock:
+            index = self.audit.setdefault(job, {'scanned': [], 'builds': {}})
+            scanned = set(index['scanned'])
+        listed = [info.get('number') for info in jresult.get('builds') or []]
+        new = [(job, number) for number in listed if number not in scanned]
+        with self.lock:
+            # Builds removed from Jenkins are not listed again.
+            listed_set = set(listed)
+            index['scanned'] = [number for number in index['scanned'] if number in listed_set]
+            for key, number in list(index['builds'].items()):
+                if number not in listed_set:
+                    del index['builds'][key]
+        if not new:
+            return
+        pool = ThreadPool(AUDIT_JOBS)
+        try:
+            audits = pool.map(self._read_audit, new, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        building = dict((info.get('number'), info.get('building'))
+                        for info in jresult.get('builds') or [])
+        with self.lock:
+            for (_, number), keys in zip(new, audits):
+                if keys is None:
+                    continue
+                for key in keys:
+                    index['builds'][key] = number
+                # Running build can get more messages, read it again next time.
+                # Finished build is not read again, even without messages.
+                if not building.get(number):
+                    index['scanned'].append(number)
+
+    def find_build(self, job, repo, branch, rev):
+        """Number of build started by message for (repo, branch, rev).
+
+        Index is updated with new builds of the job only if the build
+        is not known yet.
+
+        Returns
+        -------
+        int
+            Build number or None.
+        """
+        key = audit_key(repo, branch, rev)
+        with self.lock:
+            number = self.audit.get(job, {}).get('builds', {}).get(key)
+        if number is None:
+            with self.audit_lock:
+                with self.lock:
+                    number = self.audit.get(job, {}).get('builds', {}).get(key)
+                if number is None:
+                    self.update_audit(job)
+                    with self.lock:
+                        number = self.audit.get(job, {}).get('builds', {}).get(key)
+        return number
+
+
+def audit_key(repo, branch, rev):
+    """Index key of pipeline, rev without PR-/kojitask- prefix."""
+    return "%s %s %s" % (repo, branch, normalize_rev(str(rev)))
+
+
+class BuildWatcher(object):
+    """Waits for running builds, all of them are polled together.
+
+    One poller thread asks for status of all registered builds, one
+    request per job, then sleeps. Sleep grows exponentially from
+    first_delay up to max_delay and starts again from first_delay when a
+    new build is registered. Threads waiting in wait() are woken up when
+    their build finishes or their deadline comes.
+
+    Parameters
+    ----------
+    client : JenkinsClient
+        Client used for polling.
+    first_delay : float
+        Seconds between the first polls.
+    max_delay : float
+        Longest time between polls.
+    """
+
+    def __init__(self, client, first_delay=15, max_delay=300):
+        self.client = client
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        # {(job, number): last build info or None}
+        self.pending = {}
+        # Pending builds asked for at least once
+        self.polled = set()
+        self.waiters = {}
+        self.delay = first_delay
+        self.poller = None
+
+    def _poll(self):
+        with self.cond:
+            jobs = {}
+            for job, number in self.pending:
+                jobs.setdefault(job, []).append(number)
+        infos = {}
+        for job, numbers in jobs.items():
+            for number, info in self.client.builds(job, numbers).items():
+                infos[(job, number)] = info
+        with self.cond:
+            for key, info in infos.items():
+                if key not in self.pending:
+                    continue
+                self.polled.add(key)
+                if info is not None:
+                    self.pending[key] = info
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            self._poll()
+            with self.cond:
+                if not self.waiters:
+                    self.poller = None
+                    return
+                delay = self.delay
+                self.delay = min(self.delay * 2, self.max_delay)
+                self.cond.wait(delay)
+
+    def wait(self, job, number, deadline):
+        """Wait until the build finishes or deadline comes.
+
+        Parameters
+        ----------
+        job : str
+            Jenkins job name.
+        number : int
+            Build number.
+        deadline : float
+            time.time() when to stop waiting.
+
+        Returns
+        -------
+        dict
+            The last build info, 'building' is True if the build did not
+            finish before the deadline, also when it was not polled yet.
+            None if the build was polled, but no info could be got.
+        """
+        key = (job, number)
+        with self.cond:
+            self.pending.setdefault(key, None)
+            self.waiters[key] = self.waiters.get(key, 0) + 1
+            # New build, poll soon.
+            self.delay = self.first_delay
+            if self.poller is None:
+                self.poller = threading.Thread(target=self._run)
+                self.poller.daemon = True
+                self.poller.start()
+            else:
+                self.cond.notify_all()
+            try:
+                while True:
+                    info = self.pending.get(key)
+                    if info is not None and not info.get('building'):
+                        return info
+                    left = deadline - time.time()
+                    if left <= 0:
+                        if info is None and key not in self.polled:
+                            return {'number': number, 'building': True}
+                        return info
+                    self.cond.wait(left)
+            finally:
+                self.waiters[key] -= 1
+                if not self.waiters[key]:
+                    del self.waiters[key]
+                    del self.pending[key]
+                    self.polled.discard(key)
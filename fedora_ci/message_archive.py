@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Local archive of datagrepper messages.
+
+Messages are kept in SQLite, indexed by topic and timestamp. For every
+topic the archive remembers a high-water mark: end of the last complete
+fetch. Next run fetches only messages newer than the mark and drops
+messages which slid out of the time window.
+"""
+
+import json
+import sqlite3
+import threading
+
+# Messages can appear in datagrepper a bit later than their timestamp,
+# refresh starts this many seconds before the high-water mark.
+REFRESH_OVERLAP = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    msg_id TEXT PRIMARY KEY,
+    topic TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    body TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS messages_topic_time ON messages (topic, timestamp);
+CREATE TABLE IF NOT EXISTS high_water (
+    topic TEXT PRIMARY KEY,
+    fetched REAL NOT NULL);
+"""
+
+
+class MessageArchive(object):
+    """Datagrepper messages in SQLite file.
+
+    Parameters
+    ----------
+    path : str
+        SQLite database file, created if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def high_water(self, topic):
+        """End of the last complete fetch of topic, None if never fetched."""
+        with self.lock:
+            row = self.db.execute("SELECT fetched FROM high_water WHERE topic = ?",
+                                  (topic,)).fetchone()
+        return row[0] if row else None
+
+    def refresh_start(self, topic, window_start):
+        """Time to fetch topic from, to have all messages since window_start."""
+        mark = self.high_water(topic)
+        if mark is None or mark - REFRESH_OVERLAP < window_start:
+            return window_start
+        return mark - REFRESH_OVERLAP
+
+    def add(self, topic, messages, fetched):
+        """Store fetched messages of topic and move its high-water mark."""
+        rows = [(info.get('msg_id') or '%s-%s' % (topic, info.get('timestamp')),
+                 topic, float(info.get('timestamp', 0)), json.dumps(info))
+                for info in messages]
+        with self.lock:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)", rows)
+                self.db.execute("INSERT OR REPLACE INTO high_water VALUES (?, ?)", (topic, fetched))
+
+    def prune(self, window_start):
+        """Remove messages older than window_start.
+
+        Returns
+        -------
+        int
+            Number of removed messages.
+        """
+        with self.lock:
+            with self.db:
+                cursor = self.db.execute("DELETE FROM messages WHERE timestamp < ?", (window_start,))
+                return cursor.rowcount
+
+    def messages(self, topic, window_start):
+        """Messages of topic since window_start, newest first like datagrepper."""
+        with self.lock:
+            rows = self.db.execute("SELECT body FROM messages WHERE topic = ? AND timestamp >= ? "
+                                   "ORDER BY timestamp DESC", (topic, window_start)).fetchall()
+        return [json.loads(row[0]) for row in rows]
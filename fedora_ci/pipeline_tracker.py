@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Track CI pipelines from the message stream.
+
+Messages are consumed once from a message bus into a TopicStore, where
+every pipeline, keyed by (repo, branch, rev), has the newest message of
+each topic. Threads waiting for a topic of a pipeline are woken up when
+the message arrives, nobody polls datagrepper in a sleep loop.
+
+Buses:
+
+    DatagrepperBus - polls datagrepper for new messages of all topics
+    FakeBus        - messages are published by hand, for tests
+"""
+
+import json
+import time
+import threading
+import webclient
+from datagrepper import DATAGREPPER_URL
+from topic_store import TopicStore, pipeline_key
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Seconds between datagrepper polls.
+POLL_INTERVAL = 60
+# The first poll starts this many seconds before the end of the initial
+# topics fetch, messages can be indexed by datagrepper late.
+FOLLOW_OVERLAP = 60
+
+
+class FakeBus(object):
+    """Message bus fed by publish(), for tests."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def publish(self, info):
+        """Send datagrepper like message: {'topic': ..., 'msg': {...}}."""
+        self.queue.put(info)
+
+    def close(self):
+        self.queue.put(None)
+
+    def messages(self):
+        while True:
+            info = self.queue.get()
+            if info is None:
+                return
+            yield info
+
+
+class DatagrepperBus(object):
+    """Polls datagrepper for new messages of topics.
+
+    Parameters
+    ----------
+    topics : list
+        Topics to follow.
+    start : float
+        The first poll gets messages sent after this time.
+    interval : float
+        Seconds between polls.
+    """
+
+    def __init__(self, topics, start, interval=POLL_INTERVAL):
+        self.topics = list(topics)
+        self.start = start
+        self.interval = interval
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+    def poll(self, start):
+        """Messages sent after start, None if datagrepper failed."""
+        data = []
+        page = 1
+        pages = 1
+        while page <= pages:
+            params = [('topic', topic) for topic in self.topics]
+            params += [('start', start), ('page', page)]
+            try:
+                resp = webclient.get(DATAGREPPER_URL, params=params, verify=False)
+            except Exception as e:
+                print("FAIL: Could not connect to %s: %s" % (DATAGREPPER_URL, e))
+                return None
+            if resp.status_code != 200:
+                return None
+            try:
+                jresult = json.loads(resp.text)
+                data.extend(jresult['raw_messages'])
+                pages = int(jresult['pages'])
+            except (ValueError, KeyError, TypeError) as e:
+                print("FAIL: Unexpected datagrepper response: %s" % e)
+                return None
+            page += 1
+        return data
+
+    def messages(self):
+        seen = set()
+        start = self.start
+        while not self.closed.is_set():
+            polled = time.time()
+            data = self.poll(start)
+            if data is not None:
+                # Next poll overlaps with this one, messages can be
+                # indexed late. Duplicates are dropped by msg_id.
+                start = polled - self.interval
+                for info in data:
+                    if info.get('msg_id') in seen:
+                        continue
+                    seen.add(info.get('msg_id'))
+                    yield info
+            self.closed.wait(self.interval)
+
+
+class PipelineTracker(object):
+    """State of pipelines built from messages.
+
+    Parameters
+    ----------
+    topics : list
+        Pipeline topics, messages of other topics are ignored.
+    store : TopicStore
+        Where messages are kept, new one if not set.
+    """
+
+    def __init__(self, topics, store=None):
+        self.topics = set(topics)
+        self.store = store if store is not None else TopicStore()
+        self.cond = threading.Condition(self.store.lock)
+        self.thread = None
+        self.bus = None
+
+    def ingest(self, info):
+        """Add one datagrepper message and wake up waiters."""
+        if info.get('topic') not in self.topics or pipeline_key(info.get('msg')) is None:
+            return
+        with self.cond:
+            self.store.add(info)
+            self.cond.notify_all()
+
+    def follow(self, bus):
+        """Consume messages from bus in a background thread."""
+        def consume():
+            for info in bus.messages():
+                self.ingest(info)
+        self.bus = bus
+        self.thread = threading.Thread(target=consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop following the bus, consumer thread ends after current poll."""
+        if self.bus is not None:
+            self.bus.close()
+
+    def wait(self, key, topic, deadline=None, complete_topic=None):
+        """Wait for message of topic for pipeline.
+
+        Parameters
+        ----------
+        key : tuple
+            (repo, branch, rev), rev without PR-/kojitask- prefix.
+        topic : str
+            Expected topic.
+        deadline : float
+            time.time() when to give up, None to not wait.
+        complete_topic : str
+            Topic which ends the pipeline. If it arrives before the
+            expected topic, the expected one will never come.
+
+        Returns
+        -------
+        dict
+            Message or None.
+        """
+        with self.cond:
+            while True:
+                info = self.store.find(topic, key)
+                if info is not None:
+                    return info
+                if (complete_topic and complete_topic != topic and
+                        self.store.find(complete_topic, key) is not None):
+                    print("FAIL: pileline completed, but topic %s was never sent" % topic)
+                    return None
+                if deadline is None:
+                    return None
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self.cond.wait(left)
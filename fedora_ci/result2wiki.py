@@ -1,5 +1,6 @@
 #!/usr/bin/env python2
 
+import argparse
 import datetime
 import jinja2
 import json
@@ -8,14 +9,30 @@ import os
 import sys
 import time
 
-def render_wpage():
-    """Generate wiki page file.
+# Number of template chunks joined before write to the page file.
+J2_STREAM_BUFFER = 100
+
+# Jinja environment, keeps parsed templates, see get_template().
+j2_env = None
+
+def get_template(name):
+    """Get template. It is parsed only on the first call.
+    """
+    global j2_env
+    if j2_env is None:
+        cdir = os.path.dirname(os.path.abspath(__file__))
+        j2_loader = jinja2.FileSystemLoader(cdir)
+        j2_env = jinja2.Environment(loader=j2_loader, trim_blocks=True,
+                                    auto_reload=False)
+    return j2_env.get_template(name)
+
+def wpage_vars():
+    """Variables for wiki page template from result.json.
     Returns
     -------
-    str
-        Page to be uploaded to wiki.
+    dict
+        None if there is no results.
     """
-    print('Render wiki page')
     try:
         data = json.load(open('result.json'))
     except:
@@ -29,13 +46,37 @@ def render_wpage():
         delta = "%s minutes" % (delta / 60)
     start_time = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(data['start_time']))
 
-    cdir = os.path.dirname(os.path.abspath(__file__))
-    j2_loader = jinja2.FileSystemLoader(cdir)
-    j2_env = jinja2.Environment(loader=j2_loader, trim_blocks=True)
-    template = j2_env.get_template("wikitemplate.j2")
-    template_vars = {'updated': datetime.datetime.utcnow(), 'results': data["results"],
-                    'delta': delta, 'start_time': start_time}
-    return template.render(template_vars)
+    return {'updated': datetime.datetime.utcnow(), 'results': data["results"],
+            'delta': delta, 'start_time': start_time}
+
+def render_wpage():
+    """Generate wiki page file.
+    Returns
+    -------
+    str
+        Page to be uploaded to wiki.
+    """
+    print('Render wiki page')
+    template_vars = wpage_vars()
+    if not template_vars:
+        return None
+    return get_template("wikitemplate.j2").render(template_vars)
+
+def dump_wpage(fname):
+    """Render wiki page by chunks directly to the file.
+    Returns
+    -------
+    bool
+        False if there is no results.
+    """
+    print('Render wiki page to %s' % fname)
+    template_vars = wpage_vars()
+    if not template_vars:
+        return False
+    stream = get_template("wikitemplate.j2").stream(template_vars)
+    stream.enable_buffering(J2_STREAM_BUFFER)
+    stream.dump(fname, encoding='utf-8')
+    return True
 
 
 def publish():
@@ -67,6 +108,14 @@ def publish():
     return True
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Publish result.json on wiki')
+    parser.add_argument('--dump', metavar='FILE', default=None,
+                        help='Only write wiki page to FILE, do not publish.')
+    args = parser.parse_args()
+    if args.dump:
+        if dump_wpage(args.dump):
+            sys.exit(0)
+        sys.exit(1)
     if publish():
         sys.exit(0)
     sys.exit(1)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Datagrepper messages stored by topic.
+
+Pipeline messages are indexed per topic by (repo, branch, rev) when they
+are added. Rev is normalized once, without PR- or kojitask- prefix, so
+a lookup of a PR id or koji task id is one dict access.
+"""
+
+import threading
+
+# Prefixes of pipeline message rev, the rest is PR id or koji task id.
+REV_PREFIXES = ("PR-", "kojitask-")
+
+
+def normalize_rev(rev):
+    for prefix in REV_PREFIXES:
+        if rev.startswith(prefix):
+            return rev[len(prefix):]
+    return rev
+
+
+def pipeline_key(msg):
+    """(repo, branch, rev) of pipeline message body, None for other messages."""
+    try:
+        return (msg['repo'], msg['branch'], normalize_rev(msg['rev']))
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+class TopicStore(object):
+    """Messages of queried topics with (repo, branch, rev) index."""
+
+    def __init__(self):
+        # Shared with PipelineTracker condition.
+        self.lock = threading.RLock()
+        # {topic: [message]}
+        self.messages = {}
+        # {topic: {(repo, branch, rev): newest message}}
+        self.index = {}
+
+    def _index(self, topic, info):
+        key = pipeline_key(info.get('msg'))
+        if key is None:
+            return
+        index = self.index.setdefault(topic, {})
+        known = index.get(key)
+        if known is None or known.get('timestamp', 0) <= info.get('timestamp', 0):
+            index[key] = info
+
+    def has_topic(self, topic):
+        with self.lock:
+            return topic in self.messages
+
+    def set_topic(self, topic, data):
+        """Replace all messages of topic with data."""
+        with self.lock:
+            self.messages[topic] = list(data)
+            self.index[topic] = {}
+            for info in data:
+                self._index(topic, info)
+
+    def add(self, info):
+        """Add one message, its topic is info['topic']."""
+        topic = info.get('topic')
+        with self.lock:
+            self.messages.setdefault(topic, []).append(info)
+            self._index(topic, info)
+
+    def topic(self, topic):
+        """All messages of topic, None if topic was not queried."""
+        with self.lock:
+            return self.messages.get(topic)
+
+    def find(self, topic, key):
+        """Newest message of topic for (repo, branch, rev) or None."""
+        with self.lock:
+            return self.index.get(topic, {}).get(key)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Compact package record for stat.py.
+
+All yes/no facts about a package are bits of one int, strings are kept
+in __slots__. Record is serialized as a flat list:
+
+    [name, flags, package_url, pending_url, pending_user]
+
+Order of fields and values of flag bits must not change, new fields
+are appended to the end.
+"""
+
+# Flag bits. Do not renumber, they are saved in state files.
+FLAGS = (('test_yml', 1),
+         ('gating_yaml', 2),
+         ('missing', 4),
+         ('pending', 8),
+         ('classic', 16),
+         ('container', 32),
+         ('atomic', 64))
+FLAG_BITS = dict(FLAGS)
+TEST_TAGS = ('classic', 'container', 'atomic')
+
+
+class PkgRecord(object):
+    """Information about one package.
+
+    Flags are read as attributes: record.test_yml, record.classic, ...
+
+    Parameters
+    ----------
+    name : str
+        Name of the package.
+    """
+
+    __slots__ = ('name', 'flags', 'package_url', 'pending_url', 'pending_user')
+
+    # Same for all packages, kept for page template.
+    cell_color = '#ffffff'
+
+    def __init__(self, name, flags=0, package_url='', pending_url='',
+                 pending_user=''):
+        self.name = name
+        self.flags = flags
+        self.package_url = package_url
+        self.pending_url = pending_url
+        self.pending_user = pending_user
+
+    def has(self, flag):
+        """True if package has the flag."""
+        return bool(self.flags & FLAG_BITS[flag])
+
+    def set(self, flag, value=True):
+        """Set or clear the flag."""
+        if value:
+            self.flags |= FLAG_BITS[flag]
+        else:
+            self.flags &= ~FLAG_BITS[flag]
+
+    def to_list(self):
+        """Serialize record, see module docstring."""
+        return [self.name, self.flags, self.package_url, self.pending_url,
+                self.pending_user]
+
+    @classmethod
+    def from_list(cls, data):
+        """Restore record saved by to_list()."""
+        return cls(*data)
+
+    def __eq__(self, other):
+        return (isinstance(other, PkgRecord) and
+                self.to_list() == other.to_list())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PkgRecord(%r)' % self.to_list()
+
+
+def _flag_property(flag):
+    return property(lambda self: self.has(flag),
+                    lambda self, value: self.set(flag, value))
+
+for _flag, _ in FLAGS:
+    setattr(PkgRecord, _flag, _flag_property(_flag))
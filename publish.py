@@ -16,13 +16,20 @@
 # Author: Andrei Stepanov <astepano@redhat.com>
 #
 
-"""Purpose: Publish some document on MediaWiki.
+"""Purpose: Publish some documents on MediaWiki.
 """
 
 import os
+import re
+import sys
+import json
+import time
+import hashlib
 import logging
 import mwclient
 import argparse
+import threading
+from multiprocessing.pool import ThreadPool
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -32,6 +39,12 @@ parser = argparse.ArgumentParser(
 
 
 DEFAULT_URL='fedoraproject.org'
+DEFAULT_HASH_CACHE='.publish-hashes.json'
+# Edits per minute. Fedora wiki rate limits edits of regular users.
+DEFAULT_EDIT_RATE=30
+
+# Lines which change on every run, they are ignored by content_hash().
+VOLATILE_LINES = re.compile(r'^Page was updated on:.*$', re.MULTILINE)
 
 parser.add_argument("--url", metavar='URL', help="Wiki URL. Default: %s"
                     % DEFAULT_URL, default=DEFAULT_URL)
@@ -44,14 +57,209 @@ parser.add_argument("--passw", metavar='PASSWORD',
                     help=("Wiki user password. "
                           "If not set takes from Env variable: $WIKI_PASS"))
 
-parser.add_argument("--filedoc", metavar='DOCUMENT',
-                    required=True, help="Path to a document file to publish.")
+parser.add_argument("--filedoc", metavar='DOCUMENT', action='append',
+                    default=[],
+                    help=("Path to a document file to publish. Can be "
+                          "repeated, one per --pagepath."))
+
+parser.add_argument("--manifest", metavar='MANIFEST', action='append',
+                    default=[],
+                    help=("Publish sharded page: index to PAGEPATH and "
+                          "every shard to PAGEPATH/<key>. "
+                          "MANIFEST is written by stat.py --shard-by. "
+                          "Can be repeated, one per --pagepath."))
 
-parser.add_argument("--pagepath", metavar='PAGEPATH', required=True,
+parser.add_argument("--pagepath", metavar='PAGEPATH', action='append',
+                    default=[],
                     help=("Path to Wiki page to be updated. "
                           "Example: Section/Sub/Doc"))
 
+parser.add_argument("--pages", metavar='FILE',
+                    help=("File with pages to publish, one per line: "
+                          "DOCUMENT PAGEPATH. DOCUMENT can be a manifest "
+                          "written by stat.py --shard-by."))
+
+parser.add_argument("--jobs", metavar='N', type=int, default=1,
+                    help="Save up to N pages at the same time. Default: 1")
+
+parser.add_argument("--edit-rate", metavar='EDITS', type=float,
+                    default=DEFAULT_EDIT_RATE,
+                    help=("Max page saves per minute, 0 for no limit. "
+                          "Default: %s" % DEFAULT_EDIT_RATE))
+
+parser.add_argument("--hash-cache", metavar='FILE',
+                    help=("Keep hashes of published pages in FILE and skip "
+                          "pages which did not change. Default for "
+                          "--manifest and --pages: %s" % DEFAULT_HASH_CACHE))
+
+parser.add_argument("--skip-unchanged", action='store_true',
+                    help=("Get current page revision from wiki and do not "
+                          "save the page if only volatile lines differ."))
+
 args = parser.parse_args()
+if len(args.filedoc) + len(args.manifest) != len(args.pagepath):
+    parser.error('Every --filedoc or --manifest needs its own --pagepath')
+if args.filedoc and args.manifest:
+    parser.error('Use --pages to publish documents and manifests together')
+if not args.pagepath and not args.pages:
+    parser.error('Nothing to publish')
+
+
+def content_hash(text):
+    """Hash of page text without volatile lines.
+
+    MediaWiki strips trailing whitespace on save, it is ignored too, so
+    the hash of a local document matches the hash of its saved revision.
+    """
+    text = VOLATILE_LINES.sub('', text.replace('\r\n', '\n')).rstrip()
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def load_hashes(fname):
+    """Returns {pagepath: content hash} of previously published pages."""
+    try:
+        with open(fname) as hashes_in:
+            return json.load(hashes_in)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_hashes(fname, hashes):
+    with open(fname, 'w') as hashes_out:
+        json.dump(hashes, hashes_out, indent=4, sort_keys=True)
+
+
+def read_manifest(fname, pagepath):
+    """Returns [(pagepath, document file), ...] for sharded page.
+
+    Shards are subpages of the index page, see publish_rounds().
+    """
+    mdir = os.path.dirname(fname)
+    with open(fname) as manifest_in:
+        manifest = json.load(manifest_in)
+    pages = [("%s/%s" % (pagepath, shard['key']),
+              os.path.join(mdir, shard['file']))
+             for shard in manifest['shards']]
+    pages.append((pagepath, os.path.join(mdir, manifest['index'])))
+    return pages
+
+
+def read_pages(fname):
+    """Returns [(pagepath, document file), ...] from --pages file.
+
+    Paths of documents are relative to the file.
+    """
+    pdir = os.path.dirname(fname)
+    pages = []
+    with open(fname) as pages_in:
+        for line in pages_in:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            filedoc, pagepath = line.split(None, 1)
+            filedoc = os.path.join(pdir, filedoc)
+            if filedoc.endswith('.manifest.json'):
+                pages.extend(read_manifest(filedoc, pagepath))
+            else:
+                pages.append((pagepath, filedoc))
+    return pages
+
+
+def publish_rounds(pages):
+    """Split pages to rounds published one after another.
+
+    Pages with subpages (index pages of manifests) go to the second
+    round, which starts only when all pages of the first one are saved.
+    So an index page never links to a missing shard. Every page is a
+    tuple starting with its pagepath.
+    """
+    parents = set()
+    for page in pages:
+        parts = page[0].split('/')
+        for i in range(1, len(parts)):
+            parents.add('/'.join(parts[:i]))
+    first = [page for page in pages if page[0] not in parents]
+    second = [page for page in pages if page[0] in parents]
+    return [rnd for rnd in (first, second) if rnd]
+
+
+class EditLimiter(object):
+    """Spreads page saves evenly in time, safe for several threads."""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Publisher(object):
+    """Publishes pages over one wiki session.
+
+    Site is connected when it is needed first time. Login is done right
+    before the first save, reading pages does not need it.
+    """
+
+    def __init__(self, url, login, passw, skip_unchanged=False,
+                 edit_rate=DEFAULT_EDIT_RATE):
+        self.url = url
+        self.login = login
+        self.passw = passw
+        self.skip_unchanged = skip_unchanged
+        self.limiter = EditLimiter(edit_rate)
+        self.lock = threading.Lock()
+        self.site = None
+        self.logged_in = False
+
+    def get_site(self, need_login=False):
+        with self.lock:
+            if self.site is None:
+                ua = 'MyWikiTool/0.2 run by User:FedoraUser'
+                self.site = mwclient.Site(self.url, clients_useragent=ua)
+            if need_login and not self.logged_in:
+                self.site.login(self.login, self.passw)
+                self.logged_in = True
+            return self.site
+
+    def publish(self, pagepath, filedoc, text, digest):
+        """Save one page, errors are logged and do not stop other pages.
+
+        Returns
+        -------
+        tuple
+            (pagepath, saved: bool or None if page failed, seconds spent)
+        """
+        started = time.time()
+        try:
+            return self._publish(pagepath, filedoc, text, digest, started)
+        except Exception:
+            logger.exception("Page %s failed.", pagepath)
+            return pagepath, None, time.time() - started
+
+    def _publish(self, pagepath, filedoc, text, digest, started):
+        logger.info("DOCUMENT FILE: %s", filedoc)
+        logger.info("WIKI PAGE: %s", pagepath)
+        page = self.get_site().pages[pagepath]
+        if (self.skip_unchanged and page.exists and
+                content_hash(page.text()) == digest):
+            logger.info("Page %s on wiki has the same content, skip it.",
+                        pagepath)
+            return pagepath, False, time.time() - started
+        if not page.exists:
+            logger.info("Page %s doesn't exist. Create a new one.", pagepath)
+        self.get_site(need_login=True)
+        self.limiter.wait()
+        page.save(text, 'Auto updated.')
+        return pagepath, True, time.time() - started
 
 login = args.login
 if not login:
@@ -61,17 +269,61 @@ passw = args.passw
 if not passw:
     passw = os.environ.get('WIKI_PASS')
 
+hash_cache = args.hash_cache
+pages = [(pagepath, filedoc)
+         for pagepath, filedoc in zip(args.pagepath, args.filedoc)]
+for pagepath, manifest in zip(args.pagepath, args.manifest):
+    pages.extend(read_manifest(manifest, pagepath))
+if args.pages:
+    pages.extend(read_pages(args.pages))
+if args.manifest or args.pages:
+    hash_cache = hash_cache or DEFAULT_HASH_CACHE
+hashes = load_hashes(hash_cache) if hash_cache else {}
+
 logger.info("URL: %s", args.url)
 logger.info("LOGIN: %s", login)
-logger.info("DOCUMENT FILE: %s", args.filedoc)
-logger.info("WIKI PAGE: %s", args.pagepath)
-
-ua = 'MyWikiTool/0.2 run by User:FedoraUser'
-site = mwclient.Site(args.url, clients_useragent=ua)
-site.login(login, passw)
-page = site.pages[args.pagepath]
-if not page.exists:
-    logger.info("Page %s doesn't exist. Create a new one.", args.pagepath)
-with open(args.filedoc, 'r') as doc:
-    text = doc.read()
-page.save(text, 'Auto updated.')
+
+changed = []
+for pagepath, filedoc in pages:
+    with open(filedoc, 'r') as doc:
+        text = doc.read()
+    digest = content_hash(text)
+    if hash_cache and hashes.get(pagepath) == digest:
+        logger.info("WIKI PAGE: %s is not changed, skip it.", pagepath)
+        continue
+    changed.append((pagepath, filedoc, text, digest))
+
+publisher = Publisher(args.url, login, passw, args.skip_unchanged,
+                      args.edit_rate)
+pool = ThreadPool(max(1, args.jobs))
+saved = 0
+failed = []
+started = time.time()
+try:
+    for round_pages in publish_rounds(changed):
+        # Index page is not saved if some of its shards failed.
+        skipped = [page for page in round_pages
+                   if any(path.startswith(page[0] + '/') for path in failed)]
+        for page in skipped:
+            logger.error("Page %s skipped, its subpages failed.", page[0])
+            failed.append(page[0])
+        round_pages = [page for page in round_pages if page not in skipped]
+        results = pool.imap(lambda page: publisher.publish(*page), round_pages)
+        for (pagepath, _, _, digest), result in zip(round_pages, results):
+            _, page_saved, seconds = result
+            if page_saved is None:
+                failed.append(pagepath)
+                continue
+            logger.info("Page %s: %s in %.1f s.", pagepath,
+                        'saved' if page_saved else 'not changed', seconds)
+            saved += page_saved
+            hashes[pagepath] = digest
+            if hash_cache:
+                save_hashes(hash_cache, hashes)
+finally:
+    pool.close()
+logger.info("Published %s of %s pages in %.1f s.", saved, len(pages),
+            time.time() - started)
+if failed:
+    logger.error("Failed pages: %s", ', '.join(failed))
+    sys.exit(1)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Reusable cache of dist-git repos for checking tests.
+
+Every package is a bare repo kept between runs. A branch is fetched
+shallow once per run, then tests/ is extracted with `git archive` to a
+temporary directory. Pull request patches are applied in a temporary
+worktree. Least recently used repos are removed when the cache is over
+its disk budget.
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import contextlib
+import requests
+import webclient
+from distgit_mirror import git, DIST_GIT_URL
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'fedora-ci-repocache')
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+
+def dir_size(path):
+    """Size of all files under path in bytes."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.lstat(os.path.join(root, fname)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class RepoCache(object):
+    """Bare repos of dist-git packages under one directory.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory, one <package>.git bare repo per package.
+    base_url : str
+        Dist-git URL.
+    max_size : int
+        Disk budget in bytes, enforced by prune().
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, base_url=DIST_GIT_URL,
+                 max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.base_url = base_url
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.repo_locks = {}
+        # (package, branch) fetched in this run: True/False
+        self.fetched = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def repo_dir(self, pkg):
+        return os.path.join(self.path, pkg + '.git')
+
+    def repo_url(self, pkg):
+        return self.base_url + 'rpms/' + pkg
+
+    def repo_lock(self, pkg):
+        with self.lock:
+            return self.repo_locks.setdefault(pkg, threading.Lock())
+
+    def fetch(self, pkg, branch):
+        """Fetch branch of package, only the first call in a run does it.
+
+        Returns
+        -------
+        bool
+            True if branch is in the cache.
+        """
+        key = (pkg, branch)
+        with self.repo_lock(pkg):
+            if key not in self.fetched:
+                repo = self.repo_dir(pkg)
+                created = not os.path.isdir(repo)
+                if created:
+                    git(['init', '--quiet', '--bare', repo])
+                code, _ = git(['fetch', '--quiet', '--depth', '1',
+                               self.repo_url(pkg),
+                               '+refs/heads/%s:refs/heads/%s' % (branch, branch)],
+                              cwd=repo)
+                self.fetched[key] = code == 0
+                if code != 0 and created:
+                    shutil.rmtree(repo, ignore_errors=True)
+                elif os.path.isdir(repo):
+                    # Repo mtime is used for LRU eviction.
+                    os.utime(repo, None)
+            return self.fetched[key]
+
+    def _archive_tests(self, pkg, branch, dest):
+        fd, tar_file = tempfile.mkstemp(dir=self.path, suffix='.tar')
+        os.close(fd)
+        try:
+            code, _ = git(['archive', '--format=tar', '--output', tar_file,
+                           branch, 'tests'], cwd=self.repo_dir(pkg))
+            if code != 0:
+                return False
+            tar = tarfile.open(tar_file)
+            try:
+                tar.extractall(dest)
+            finally:
+                tar.close()
+            return True
+        finally:
+            os.remove(tar_file)
+
+    def _apply_pr(self, pkg, branch, pr, dest):
+        url = '%s/pull-request/%s.patch' % (self.repo_url(pkg), pr)
+        try:
+            response = webclient.get(url)
+        except requests.RequestException as e:
+            print("FAIL: Could not get %s: %s" % (url, e))
+            return False
+        if response.status_code != 200:
+            return False
+        patch = os.path.join(dest, 'pr.patch')
+        with open(patch, 'wb') as patch_out:
+            patch_out.write(response.content)
+        work = os.path.join(dest, pkg)
+        with self.repo_lock(pkg):
+            code, _ = git(['worktree', 'add', '--detach', work, branch],
+                          cwd=self.repo_dir(pkg))
+        if code != 0:
+            return False
+        code, _ = git(['apply', patch], cwd=work)
+        return code == 0
+
+    def _remove_worktree(self, pkg, dest):
+        work = os.path.join(dest, pkg)
+        if os.path.isdir(work):
+            with self.repo_lock(pkg):
+                git(['worktree', 'remove', '--force', work],
+                    cwd=self.repo_dir(pkg))
+                git(['worktree', 'prune'], cwd=self.repo_dir(pkg))
+
+    @contextlib.contextmanager
+    def tests(self, pkg, branch='master', pr=None):
+        """Temporary copy of tests/ directory of the package.
+
+        Usage::
+
+            with cache.tests('bash', 'master', pr='12') as tests_dir:
+                ...
+
+        Parameters
+        ----------
+        pkg : str
+            Package name.
+        branch : str
+            Branch name.
+        pr : str
+            Pull request id, its patch is applied to the branch.
+
+        Yields
+        ------
+        str
+            Path to tests directory, None if there are no tests or the
+            branch or patch could not be got. Directory is removed when
+            the with block ends.
+        """
+        dest = tempfile.mkdtemp(prefix='tests-%s-' % pkg)
+        try:
+            tests_dir = None
+            if self.fetch(pkg, branch):
+                if pr:
+                    if self._apply_pr(pkg, branch, pr, dest):
+                        tests_dir = os.path.join(dest, pkg, 'tests')
+                elif self._archive_tests(pkg, branch, dest):
+                    tests_dir = os.path.join(dest, 'tests')
+            if tests_dir is not None and not os.path.isdir(tests_dir):
+                tests_dir = None
+            yield tests_dir
+        finally:
+            if pr:
+                self._remove_worktree(pkg, dest)
+            shutil.rmtree(dest, ignore_errors=True)
+
+    def prune(self):
+        """Remove least recently used repos above disk budget.
+
+        Returns
+        -------
+        int
+            Number of removed repos.
+        """
+        repos = []
+        total = 0
+        for fname in os.listdir(self.path):
+            repo = os.path.join(self.path, fname)
+            if not fname.endswith('.git') or not os.path.isdir(repo):
+                continue
+            size = dir_size(repo)
+            repos.append((os.path.getmtime(repo), size, repo))
+            total += size
+        repos.sort()
+        removed = 0
+        for _, size, repo in repos:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(repo, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
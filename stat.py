@@ -19,31 +19,87 @@
 # http://sphinxcontrib-napoleon.readthedocs.io/en/latest/index.html
 
 import os
-import re
 import sys
-import copy
+import json
+import time
 import jinja2
+import hashlib
 import pprint
 import argparse
 import datetime
 import requests
+import functools
+import threading
+import webclient
+import testtags
+import pkgrecord
+import distgit_mirror
+import concurrent.futures
+from urllib.parse import urlparse
 
 DIST_GIT_URL = 'https://src.fedoraproject.org/'
 J2_WIKI_TEMPLATE = 'page.j2'
-
-# Package info schema.
-pkg_template = {'name': '',
-                'cell_color': '#ffffff',
-                'distgit': {
-                    'package_url': '',
-                    'test_yml': '',
-                    'gating_yaml': '',
-                    'missing': '',
-                    'pending': {'status': '', 'url': '', 'user': {}},
-                    'test_tags': {'classic': '', 'container': '', 'atomic': ''}}}
+# Index page of sharded output.
+J2_INDEX_TEMPLATE = 'index.j2'
+DEFAULT_SHARD_ROWS = 500
+# Number of template chunks joined before write to the page file.
+J2_STREAM_BUFFER = 100
+# Files in dist-git checked for existence for every package.
+DISTGIT_PROBES = ('tests/tests.yml', 'gating.yaml')
+DATAGREPPER_URL = 'https://apps.fedoraproject.org/datagrepper/raw'
+# Messages about changes in dist-git repos and pull requests.
+CHANGE_TOPICS = ('org.fedoraproject.prod.git.receive',
+                 'org.fedoraproject.prod.pagure.pull-request.new',
+                 'org.fedoraproject.prod.pagure.pull-request.comment.added',
+                 'org.fedoraproject.prod.pagure.pull-request.closed')
+# Incremental scan falls back to full scan if state is older.
+MAX_INCREMENTAL_AGE = 7 * 24 * 3600
+STATE_VERSION = 3
 
 ipkgs = dict()
 purpose = "Unknown packages list."
+# Local dist-git mirror, see distgit_mirror. None - use HTTP.
+mirror = None
+# Jinja environment, keeps parsed templates, see get_template().
+j2_env = None
+
+# Default limit of requests per second sent to a single host when
+# packages are checked in parallel.
+DEFAULT_HOST_RATE = 10
+
+class HostRateLimiter(object):
+    """Spreads requests to the same host evenly in time.
+
+    Every host gets its own schedule, so slow dist-git does not throttle
+    requests to other sites. Safe to use from several threads.
+
+    Parameters
+    ----------
+    rate : float
+        Maximum requests per second for a single host. 0 disables limit.
+    """
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.next_slot = dict()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+
+    def wait(self, url):
+        """Blocks until a request to the url host is allowed."""
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+rate_limiter = HostRateLimiter()
 
 def printl(level, string, *args, **kargs):
     msg = " " * 4 + string
@@ -61,65 +117,132 @@ def print3(*args, **kargs):
 def print4(*args, **kargs):
     printl(4, *args, **kargs)
 
-def get_pkgs_stat():
-    """Generataes packages statistic.
+def http_get(url):
+    """GET request honoring per-host rate limit.
+
+    Fresh responses from cache are not rate limited, only requests sent
+    over network are.
 
     Parameters
     ----------
-    packages : list
-        List of packages.
+    url : str
+        Url to get.
 
     Returns
     -------
-    dict
-        Statistic in json.
+    requests.Response
     """
-    print1('Calculate packages summary.')
-    stat = {'total': '',
-                      'distgit': {
-                          'test_yml': '',
-                          'gating_yaml': '',
-                          'missing': '',
-                          'pending': '',
-                          'test_tags': {'classic': '', 'container': '', 'atomic': ''}}}
-
-    stat['total'] = len(ipkgs)
-    total = pkgs_in_cat('distgit', 'test_yml')
-    stat['distgit']['test_yml'] = total
-    total = pkgs_in_cat('distgit', 'gating_yaml')
-    stat['distgit']['gating_yaml'] = total
-    total = pkgs_in_cat('distgit', 'missing')
-    stat['distgit']['missing'] = total
-    total = pkgs_in_cat('distgit', 'pending', 'status')
-    stat['distgit']['pending'] = total
-    total = pkgs_in_cat('distgit', 'test_tags', 'classic')
-    stat['distgit']['test_tags']['classic'] = total
-    total = pkgs_in_cat('distgit', 'test_tags', 'container')
-    stat['distgit']['test_tags']['container'] = total
-    total = pkgs_in_cat('distgit', 'test_tags', 'atomic')
-    stat['distgit']['test_tags']['atomic'] = total
-    print1('Packages stat: %s' % pprint.pformat(stat))
-    return stat
+    return webclient.cached_get(url, before_request=rate_limiter.wait)
+
+class PkgsStat(object):
+    """Packages flags stored as bit columns.
+
+    Column of a flag is an int where bit N is set if N-th package has the
+    flag. Columns are built in one pass over packages, then any category
+    is a few bitwise operations and one popcount.
+
+    Parameters
+    ----------
+    pkgs : dict
+        {name: PkgRecord}
+    """
+
+    def __init__(self, pkgs):
+        self.total = len(pkgs)
+        self.all = (1 << self.total) - 1
+        bits = dict((name, []) for name, _ in pkgrecord.FLAGS)
+        for record in pkgs.values():
+            for name, bit in pkgrecord.FLAGS:
+                bits[name].append('1' if record.flags & bit else '0')
+        # Package N is bit N, so the string is reversed.
+        self.columns = dict((name, int(''.join(reversed(column)) or '0', 2))
+                            for name, column in bits.items())
+
+    def count(self, have=(), without=()):
+        """Number of packages with all `have` flags and no `without` flags."""
+        mask = self.all
+        for name in have:
+            mask &= self.columns[name]
+        for name in without:
+            mask &= ~self.columns[name]
+        return bin(mask).count('1')
+
+    def count_expr(self, expr):
+        """Count packages in category given as string.
 
-def pkgs_in_cat(*args):
-    """Returns stats for package.
+        Expression is comma separated flags, `!` negates flag, for
+        example: 'test_yml,!gating_yaml'.
+        """
+        have = []
+        without = []
+        for name in expr.split(','):
+            name = name.strip()
+            if name.startswith('!'):
+                without.append(name[1:])
+            else:
+                have.append(name)
+        for name in have + without:
+            if name not in self.columns:
+                raise ValueError('Unknown flag %s in category %s' % (name, expr))
+        return self.count(have, without)
+
+    def crosstab(self, row, col):
+        """Cross-tab of two flags.
+
+        Returns
+        -------
+        dict
+            {(row value, col value): count} for True/False values.
+        """
+        table = {}
+        for row_value in (True, False):
+            for col_value in (True, False):
+                flags = ((row, row_value), (col, col_value))
+                table[(row_value, col_value)] = self.count(
+                    [name for name, value in flags if value],
+                    [name for name, value in flags if not value])
+        return table
+
+    def fmt(self, found):
+        """Formatted string, for example: '48 (42%)'."""
+        percent = round((100 * found) / self.total) if self.total else 0
+        return "{} ({}%)".format(found, percent)
+
+def get_pkgs_stat(pkgs=None, categories=None):
+    """Generataes packages statistic.
+
+    Parameters
+    ----------
+    pkgs : dict
+        Packages info, default: ipkgs.
+    categories : list
+        User defined categories: [(title, expression), ...], see
+        PkgsStat.count_expr().
 
     Returns
     -------
-    str
-        Formatted string, for example: '48 (42%)'.
+    dict
+        Statistic in json.
     """
-    total_packages = len(ipkgs)
-    found = 0
-    for pkg, ipkg in ipkgs.items():
-        if len(args) == 2:
-            if ipkg[args[0]][args[1]]:
-                found += 1
-        else:
-            if ipkg[args[0]][args[1]][args[2]]:
-                found += 1
-    percent = round((100 * found) / total_packages)
-    stat = "{} ({}%)".format(found, percent)
+    print1('Calculate packages summary.')
+    if pkgs is None:
+        pkgs = ipkgs
+    pstat = PkgsStat(pkgs)
+    count = lambda name: pstat.fmt(pstat.count([name]))
+    stat = {'total': pstat.total,
+            'distgit': {
+                'test_yml': count('test_yml'),
+                'gating_yaml': count('gating_yaml'),
+                'missing': count('missing'),
+                'pending': count('pending'),
+                'test_tags': {'classic': count('classic'),
+                              'container': count('container'),
+                              'atomic': count('atomic')}},
+            'categories': [(title, pstat.fmt(pstat.count_expr(expr)))
+                           for title, expr in categories or []]}
+    print1('Packages stat: %s' % pprint.pformat(stat))
+    print1('tests.yml / gating.yaml cross-tab: %s'
+           % pprint.pformat(pstat.crosstab('test_yml', 'gating_yaml')))
     return stat
 
 def get_prs(base_url, pkg):
@@ -139,7 +262,10 @@ def get_prs(base_url, pkg):
     """
     print2("Get PR list.")
     url = base_url + 'api/0/rpms/' + pkg + '/pull-requests'
-    response = requests.get(url)
+    response = http_get(url)
+    if response.status_code >= 500:
+        print("Can't get {} URL. It will be skipped".format(url))
+        return
     try:
         pr = response.json()
     except ValueError:
@@ -158,8 +284,11 @@ def get_pr(prs):
     Returns
     -------
     json
-        {'user': <username>, 'url': <pull_req_url>}
+        {'user': <username>, 'url': <pull_req_url>}, or
+        {'error_code': 'ENOPROJECT'} if project is missing in dist-git.
     """
+    if isinstance(prs, dict) and prs.get('error_code') == 'ENOPROJECT':
+        return {'error_code': 'ENOPROJECT'}
     if not isinstance(prs, dict) or  'total_requests' not in prs:
         print2("Bad call to get_pr() with arg: %s" % pprint.pformat(prs))
         return
@@ -182,6 +311,17 @@ def get_projects_url_patches(json_response):
         projects_url_patches.append(project_name)
     return projects_url_patches
 
+def pool_map(func, items, jobs=1):
+    """Like map(), but calls func in `jobs` threads. Keeps items order.
+
+    Returns
+    -------
+    list
+    """
+    if jobs <= 1:
+        return [func(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
 
 def get_site_file(url, pkg, fname):
     """Get file from the site.
@@ -197,7 +337,12 @@ def get_site_file(url, pkg, fname):
 
     Returns
     -------
-        test.yaml (raw string)
+        test.yaml (raw string), None if there is no such file.
+
+    Raises
+    ------
+    requests.RequestException
+        If the site failed to answer.
     """
     if 'upstreamfirst' in url:
         url = url + pkg + '/raw/master/f/' + fname
@@ -206,9 +351,40 @@ def get_site_file(url, pkg, fname):
     else:
         return
     print3('Get %s' % url)
-    response = requests.get(url)
+    response = http_get(url)
+    if response.status_code >= 500:
+        response.raise_for_status()
+    if response.status_code != 200:
+        return None
     return response.text
 
+def get_distgit_file(pkg, path):
+    """Get file from package repo in dist-git.
+
+    Returns
+    -------
+        File content (raw string), None if there is no such file.
+
+    Raises
+    ------
+    requests.RequestException
+        If dist-git failed to answer.
+    """
+    url = DIST_GIT_URL + 'rpms/' + pkg + '/raw/master/f/' + path
+    print3('Get %s' % url)
+    response = http_get(url)
+    if response.status_code >= 500:
+        response.raise_for_status()
+    if response.status_code != 200:
+        return None
+    return response.text
+
+def content_hash(text):
+    """sha1 of file content, None for missing file."""
+    if text is None:
+        return None
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
 
 def get_url_to_test_yml(url, package):
     """Get url to the test.yml file
@@ -252,9 +428,29 @@ def get_url_to_gating_yaml(url, package):
         return
     return gating_file_url
 
+def get_url_to_file(url, package, path):
+    """Get url to the file in dist-git.
+
+    Parameters
+    ----------
+    url : str
+        Url, for example: 'https://src.fedoraproject.org/'
+    package : str
+        Name of the package.
+    path : str
+        Path to the file in repo, for example: 'tests/tests.yml'
+
+    Returns
+    -------
+        Url string.
+    """
+    return url + 'rpms/' + package + '/blob/master/f/' + path
+
 def remote_file_exists(url):
     """Checks if file exists.
 
+    Body of the page is not downloaded, see webclient.exists().
+
     Parameters
     ----------
     url : str
@@ -263,36 +459,45 @@ def remote_file_exists(url):
     Returns
     -------
     bool
-        True/False if file exists.
+        True/False if file exists, None if it could not be checked.
     """
-    response = requests.get(url)
-    if response.status_code == 200:
-        return True
-    else:
-        return False
+    rate_limiter.wait(url)
+    try:
+        return webclient.exists(url)
+    except requests.RequestException as e:
+        print("Can't check {}: {}".format(url, e))
+        return None
 
-def get_test_tags(raw_text):
-    """Just returns existed test-tags.
+def files_exist(pairs, jobs=1):
+    """Checks existence of many files in dist-git at once.
 
     Parameters
     ----------
-    raw_text : str
-        Raw text output from the requests.
+    pairs : list
+        List of (package, path) tuples.
+    jobs : int
+        Number of checks done at the same time.
 
-    Returns:
-        tags (list if strings)
+    Returns
+    -------
+    dict
+        {(package, path): True/False/None}, see remote_file_exists().
     """
-    test_tags = []
-    # XXX: classic container atomic - can be commente out.
-    for tag in ['classic', 'container', 'atomic']:
-        if tag in raw_text:
-            test_tags.append(tag)
-    return test_tags
+    urls = [get_url_to_file(DIST_GIT_URL, pkg, path) for pkg, path in pairs]
+    return dict(zip(pairs, pool_map(remote_file_exists, urls, jobs)))
 
+def get_mirror_file(pkg, fname):
+    """Get file from tests/ in local mirror.
 
-def handle_test_tags(url, pkg):
-    """Gets new path to the test.yaml if existing test.yaml includes
-    test file.
+    Returns
+    -------
+        File content (raw string), None if there is no such file.
+    """
+    print3('Read %s/tests/%s from mirror' % (pkg, fname))
+    return mirror.read(pkg, 'tests/' + fname)
+
+def handle_test_tags(url, pkg, get_file=get_site_file):
+    """Gets test tags from tests.yml and playbooks it includes.
 
     Parameters
     ----------
@@ -300,131 +505,533 @@ def handle_test_tags(url, pkg):
         Example: 'https://upstreamfirst.fedorainfracloud.org/'
     pkg : str
         Name of the pkg.
+    get_file : function
+        get_file(url, pkg, fname) returns content of tests/fname.
 
     Returns
     -------
     list
         List of strings.
     """
-    raw_text = get_site_file(url, pkg, 'tests.yml')
-    if 'Page not found' in raw_text:
+    extractor = testtags.TagExtractor(lambda fname: get_file(url, pkg, fname))
+    tags = extractor.tags('tests.yml')
+    if tags is None:
         print4('No tests.yml.')
         return []
-    tags = get_test_tags(raw_text)
-    if not tags:
-        new_test_file = re.findall(r'(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', raw_text)
-        if new_test_file:
-            raw_text = get_site_file(url, pkg, new_test_file[-1])
-            tags = get_test_tags(raw_text)
     print4('Found tags: %s' % pprint.pformat(tags))
     return tags
 
-def tags2dict(test_tags):
-    """Convert test-tags list to the dictionary.
+def get_pkg_info(pkg, files=None):
+    """Gather package information.
+
+    Parameters
+    ----------
+    pkg : str
+        Name of the package.
+    files : dict
+        Result of files_exist() for DISTGIT_PROBES of the package.
+        Checked here if not set.
+
+    Returns
+    -------
+    tuple
+        (PkgRecord, hashes). Hashes are {path: content_hash()} of
+        DISTGIT_PROBES, None if some probe failed and the record may be
+        wrong.
     """
-    dict = {'classic': False, 'container': False, 'atomic': False}
+    site_file = get_site_file
+    read_file = get_distgit_file
+    if mirror is not None and mirror.has(pkg):
+        files = dict(((pkg, path), mirror.exists(pkg, path))
+                     for path in DISTGIT_PROBES)
+        site_file = lambda url, pkg, fname: get_mirror_file(pkg, fname)
+        read_file = mirror.read
+    elif files is None or (pkg, DISTGIT_PROBES[0]) not in files:
+        files = files_exist([(pkg, path) for path in DISTGIT_PROBES])
+    contents = {}
+    def get_file(url, pkg, fname):
+        text = site_file(url, pkg, fname)
+        contents.setdefault('tests/' + fname, text)
+        return text
+    record = pkgrecord.PkgRecord(pkg)
+    failed = any(files[(pkg, path)] is None for path in DISTGIT_PROBES)
     try:
-        for tag in test_tags:
-            dict[tag] = True
-    except TypeError:
-        pass
-    return dict
+        raw_text = get_prs(DIST_GIT_URL, pkg)
+        pr = get_pr(raw_text)
+        if pr:
+            if 'url' in pr:
+                record.pending_url = pr['url']
+                record.pending_user = (pr['user'] or {}).get('name', '')
+                record.pending = True
+            elif pr.get('error_code') == 'ENOPROJECT':
+                record.missing = True
+        elif not isinstance(raw_text, dict) or 'total_requests' not in raw_text:
+            failed = True
+        # Get distgit test-tags
+        for tag in handle_test_tags(DIST_GIT_URL, pkg, get_file):
+            record.set(tag)
+        if files[(pkg, 'gating.yaml')]:
+            contents['gating.yaml'] = read_file(pkg, 'gating.yaml')
+    except requests.RequestException as e:
+        print("Can't check {}: {}".format(pkg, e))
+        failed = True
+    record.test_yml = bool(files[(pkg, 'tests/tests.yml')])
+    if files[(pkg, 'gating.yaml')]:
+        record.gating_yaml = True
+        record.package_url = get_url_to_gating_yaml(DIST_GIT_URL, pkg)
 
-def get_pkg_info(pkg):
-    """Gather package information.
+    #print4('Pkg info: %s' % record)
+    if failed:
+        return record, None
+    return record, dict((path, content_hash(contents.get(path)))
+                        for path in DISTGIT_PROBES)
+
+def load_state(fname):
+    """Load packages state saved by previous run.
+
+    Returns
+    -------
+    dict
+        {pkg: {'info': <PkgRecord.to_list()>, 'checked': <time>,
+               'hashes': {path: <sha1>}}}, see get_pkg_info().
     """
-    info = copy.deepcopy(pkg_template)
-    info['name'] = pkg
-    raw_text = get_prs(DIST_GIT_URL, pkg)
-    pr = get_pr(raw_text)
-    if pr:
-        try:
-            info['distgit']['pending']['url'] = pr['url']
-            info['distgit']['pending']['user'] = pr['user']
-            info['distgit']['pending']['status'] = True
-        except KeyError:
-            if pr['error_code'] == 'ENOPROJECT':
-                info['distgit']['missing'] = True
-    elif pr is None:
-        info['distgit']['pending']['url'] = ''
-        info['distgit']['pending']['user'] = ''
-        info['distgit']['pending']['status'] = False
-    # Get distgit test-tags
-    dist_git_test_tags = handle_test_tags(DIST_GIT_URL, pkg)
-    dist_git_test_tags = tags2dict(dist_git_test_tags)
-    info['distgit']['test_tags'] = dist_git_test_tags
-    dist_git_url_to_test_yml = get_url_to_test_yml(DIST_GIT_URL, pkg)
-    if remote_file_exists(dist_git_url_to_test_yml):
-        info['distgit']['test_yml'] = True
-        info['distgit']['package_url'] = dist_git_url_to_test_yml
-    else:
-        info['distgit']['test_yml'] = False
-        info['distgit']['package_url'] = ''
-    dist_git_url_to_gating_yaml = get_url_to_gating_yaml(DIST_GIT_URL, pkg)
-    if remote_file_exists(dist_git_url_to_gating_yaml):
-        info['distgit']['gating_yaml'] = True
-        info['distgit']['package_url'] = dist_git_url_to_gating_yaml
+    try:
+        with open(fname) as state_in:
+            state = json.load(state_in)
+    except (IOError, ValueError):
+        print1('No usable state in %s' % fname)
+        return {}
+    if state.get('version') != STATE_VERSION:
+        print1('Ignore state %s with version %s' % (fname, state.get('version')))
+        return {}
+    return state['packages']
+
+def save_state(fname, state):
+    """Atomically write packages state, see load_state()."""
+    tmp_name = fname + '.tmp'
+    with open(tmp_name, 'w') as state_out:
+        json.dump({'version': STATE_VERSION, 'packages': state}, state_out,
+                  sort_keys=True)
+    os.rename(tmp_name, fname)
+
+def msg_package(msg):
+    """Returns rpms package name the datagrepper message is about."""
+    body = msg.get('msg', {})
+    if 'commit' in body:
+        project = {'name': body['commit'].get('repo'),
+                   'namespace': body['commit'].get('namespace')}
+    elif 'pullrequest' in body:
+        project = body['pullrequest'].get('project') or {}
     else:
-        info['distgit']['gating_yaml'] = False
-        info['distgit']['package_url'] = ''
+        return
+    if project.get('namespace') != 'rpms':
+        return
+    return project.get('name')
+
+def get_changed_pkgs(delta):
+    """Get packages changed in dist-git in the last `delta` seconds.
+
+    Returns
+    -------
+    dict
+        {pkg: <time of the last change>}, None if datagrepper failed.
+    """
+    print1('Get dist-git changes for the last %s seconds.' % int(delta))
+    params = [('topic', topic) for topic in CHANGE_TOPICS]
+    params += [('delta', int(delta)), ('rows_per_page', 100)]
+    changed = dict()
+    page = 1
+    pages = 1
+    while page <= pages:
+        try:
+            response = webclient.get(DATAGREPPER_URL,
+                                     params=params + [('page', page)])
+            data = response.json()
+            pages = int(data['pages'])
+        except (ValueError, KeyError, requests.RequestException):
+            print1("Can't get datagrepper page %s." % page)
+            return
+        for msg in data['raw_messages']:
+            pkg = msg_package(msg)
+            if pkg:
+                changed[pkg] = max(changed.get(pkg, 0), msg['timestamp'])
+        page += 1
+    print1('Changed packages: %s' % len(changed))
+    return changed
+
+def carry_forward(pkgs, state):
+    """Select packages which do not need to be checked again.
+
+    Returns
+    -------
+    dict
+        {pkg: <PkgRecord from state>}
+    """
+    known = [pkg for pkg in pkgs if pkg in state]
+    if not known:
+        return {}
+    since = min(state[pkg]['checked'] for pkg in known)
+    if time.time() - since > MAX_INCREMENTAL_AGE:
+        print1('State is too old, check all packages.')
+        return {}
+    # A minute more to cover clock skew between us and datagrepper.
+    changed = get_changed_pkgs(time.time() - since + 60)
+    if changed is None:
+        return {}
+    return dict((pkg, pkgrecord.PkgRecord.from_list(state[pkg]['info']))
+                for pkg in known
+                if changed.get(pkg, 0) < state[pkg]['checked'])
+
+def check_pkg(pkg, files=None):
+    print("Checking %s: " % pkg)
+    return get_pkg_info(pkg, files)
+
+def scan_pkgs(pkgs, jobs=1, known=None):
+    """Gather information for all packages into ipkgs.
+
+    Packages are checked by pool of `jobs` threads. Results are stored in
+    the same order as in `pkgs`, so the rendered page does not depend on
+    the number of jobs.
 
-    #print4('Pkg info: %s' % pprint.pformat(info))
-    ipkgs[pkg] = info
+    Parameters
+    ----------
+    pkgs : list
+        List of package names.
+    jobs : int
+        Number of packages checked at the same time.
+    known : dict
+        {pkg: PkgRecord} for packages which are not checked again.
 
-def render_wpage():
+    Returns
+    -------
+    dict
+        {pkg: hashes} for packages which were checked, see get_pkg_info().
+    """
+    known = known or {}
+    all_pkgs = pkgs
+    pkgs = [pkg for pkg in all_pkgs if pkg not in known]
+    print1('Check %s packages, carry forward %s.' % (len(pkgs), len(known)))
+    probe_pkgs = pkgs
+    if mirror is not None:
+        print1('Sync %s packages in mirror %s.' % (len(pkgs), mirror.path))
+        synced = pool_map(mirror.sync, pkgs, jobs)
+        probe_pkgs = [pkg for pkg, done in zip(pkgs, synced) if not done]
+        print1('Not synced, will be checked over HTTP: %s' % probe_pkgs)
+    pairs = [(pkg, path) for pkg in probe_pkgs for path in DISTGIT_PROBES]
+    print1('Check existence of %s files in dist-git.' % len(pairs))
+    files = files_exist(pairs, jobs)
+    check = functools.partial(check_pkg, files=files)
+    checked = dict(zip(pkgs, pool_map(check, pkgs, jobs)))
+    # Results are stored in order of input packages.
+    for pkg in all_pkgs:
+        ipkgs[pkg] = checked[pkg][0] if pkg in checked else known[pkg]
+    return dict((pkg, hashes) for pkg, (_, hashes) in checked.items())
+
+def get_template(name):
+    """Get template. It is parsed only on the first call.
+
+    Returns
+    -------
+    jinja2.Template
+    """
+    global j2_env
+    if j2_env is None:
+        cdir = os.path.dirname(os.path.abspath(__file__))
+        j2_loader = jinja2.FileSystemLoader(cdir)
+        # Included parts end with a newline, it must not be dropped.
+        j2_env = jinja2.Environment(loader=j2_loader, trim_blocks=True,
+                                    keep_trailing_newline=True,
+                                    auto_reload=False)
+    return j2_env.get_template(name)
+
+def wpage_vars(pkgs=None, desc=None, categories=None):
+    """Variables for wiki page template.
+
+    Parameters
+    ----------
+    pkgs : dict
+        Packages info, default: ipkgs.
+    desc : str
+        Packages list purpose, default: purpose.
+    categories : list
+        User defined categories, see get_pkgs_stat().
+
+    Returns
+    -------
+    dict
+    """
+    if pkgs is None:
+        pkgs = ipkgs
+    pkgs_stat = get_pkgs_stat(pkgs, categories)
+    return {'updated': datetime.datetime.utcnow(),
+            'total': pkgs_stat, 'pkgs': pkgs,
+            'purpose' : desc or purpose}
+
+def render_wpage(pkgs=None, desc=None, categories=None):
     """Generate wiki page file.
 
+    Parameters are the same as for wpage_vars().
+
     Returns
     -------
     str
         Page to be uploaded to wiki.
     """
     print1('Render wiki page')
-    pkgs_stat = get_pkgs_stat()
-    cdir = os.path.dirname(os.path.abspath(__file__))
-    j2_loader = jinja2.FileSystemLoader(cdir)
-    j2_env = jinja2.Environment(loader=j2_loader, trim_blocks=True)
-    template = j2_env.get_template(J2_WIKI_TEMPLATE)
-    template_vars = {'updated': datetime.datetime.utcnow(),
-                     'total': pkgs_stat, 'pkgs': ipkgs,
-                     'purpose' : purpose}
-    return template.render(template_vars)
+    template = get_template(J2_WIKI_TEMPLATE)
+    return template.render(wpage_vars(pkgs, desc, categories))
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Gather stats about tests in dist-git')
-    parser.add_argument("--wikipage", metavar='WFILE', default=None,
-                        help="Dump output to FILE in MediaWiki format.")
-    parser.add_argument("--purpose", metavar='PURPOSE', default=None,
-                        help="Set purpose desc for wiki page..")
-    parser.add_argument("--projects", metavar='PFILE', default=None,
-                        required=True, help="File with repos.")
-    parser.add_argument("--short", help="Proceed only first 10 repos.",
-                        action='store_true')
-    opts = parser.parse_args()
-    print("Read file with projects list: %s" % opts.projects)
-    with open(opts.projects) as pkgs_in:
+def write_wpage(fname, pkgs=None, desc=None, categories=None):
+    """Render wiki page directly to the file.
+
+    Page is written by chunks while it is rendered, so the whole page is
+    never kept in memory. Other parameters are the same as for
+    wpage_vars().
+
+    Parameters
+    ----------
+    fname : str
+        Output file.
+    """
+    print1('Render wiki page to %s' % fname)
+    template = get_template(J2_WIKI_TEMPLATE)
+    stream = template.stream(wpage_vars(pkgs, desc, categories))
+    stream.enable_buffering(J2_STREAM_BUFFER)
+    stream.dump(fname, encoding='utf-8')
+
+def shard_key(name):
+    """Shard of the package in split by first letter."""
+    first = name[:1].lower()
+    if 'a' <= first <= 'z':
+        return first
+    return '0-9'
+
+def shard_pkgs(pkgs, shard_by, rows=DEFAULT_SHARD_ROWS):
+    """Split packages to shards.
+
+    Parameters
+    ----------
+    pkgs : dict
+        Packages info.
+    shard_by : str
+        'letter' - by first letter of package name, 'rows' - by `rows`
+        packages in input order.
+
+    Returns
+    -------
+    list
+        [(key, {name: record}), ...]
+    """
+    shards = dict()
+    for num, (name, record) in enumerate(pkgs.items()):
+        if shard_by == 'letter':
+            key = shard_key(name)
+        else:
+            key = str(num // rows + 1)
+        shards.setdefault(key, dict())[name] = record
+    if shard_by == 'letter':
+        return sorted(shards.items())
+    return sorted(shards.items(), key=lambda shard: int(shard[0]))
+
+def write_sharded_wpage(fname, pkgs, desc, categories, shard_by,
+                        rows=DEFAULT_SHARD_ROWS):
+    """Render index page to fname and every shard to its own file.
+
+    For page.mw shards are page-<key>.mw. List of shards is saved to
+    page.manifest.json, publish.py uses it to publish all pages.
+    """
+    base, ext = os.path.splitext(fname)
+    desc = desc or purpose
+    manifest = {'index': os.path.basename(fname), 'shards': []}
+    for key, shard in shard_pkgs(pkgs, shard_by, rows):
+        shard_fname = '%s-%s%s' % (base, key, ext)
+        title = '%s, part %s' % (desc, key)
+        write_wpage(shard_fname, shard, title, categories)
+        manifest['shards'].append({'key': key, 'title': title,
+                                   'file': os.path.basename(shard_fname),
+                                   'packages': len(shard)})
+    print1('Render index page to %s' % fname)
+    template_vars = wpage_vars(pkgs, desc, categories)
+    template_vars['shards'] = manifest['shards']
+    stream = get_template(J2_INDEX_TEMPLATE).stream(template_vars)
+    stream.dump(fname, encoding='utf-8')
+    with open(base + '.manifest.json', 'w') as manifest_out:
+        json.dump(manifest, manifest_out, indent=4, sort_keys=True)
+
+def read_pkgs_list(fname, short=False):
+    """Read packages list file, skip comments.
+
+    Returns
+    -------
+    list
+        Package names.
+    """
+    print("Read file with projects list: %s" % fname)
+    with open(fname) as pkgs_in:
         pkgs = pkgs_in.read().splitlines()
     pkgs_dup = list(pkgs)
     for line in pkgs_dup:
         if line.startswith('#'):
             pkgs.remove(line)
-    if opts.short:
+    if short:
         pkgs = pkgs[:10]
+    return pkgs
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Gather stats about tests in dist-git')
+    parser.add_argument("--wikipage", metavar='WFILE', action='append',
+                        help=("Dump output to FILE in MediaWiki format. "
+                              "One per --projects."))
+    parser.add_argument("--purpose", metavar='PURPOSE', action='append',
+                        help=("Set purpose desc for wiki page. "
+                              "One per --projects."))
+    parser.add_argument("--projects", metavar='PFILE', action='append',
+                        required=True,
+                        help=("File with repos. Can be repeated, every "
+                              "package is checked once for all lists."))
+    parser.add_argument("--short", help="Proceed only first 10 repos.",
+                        action='store_true')
+    parser.add_argument("--jobs", metavar='N', type=int, default=1,
+                        help="Check N packages in parallel. Default: 1")
+    parser.add_argument("--host-rate", metavar='RATE', type=float,
+                        help=("Max requests per second to a single host, "
+                              "0 for no limit. Default: %s with --jobs "
+                              "above 1, no limit otherwise" % DEFAULT_HOST_RATE))
+    parser.add_argument("--http-timeout", metavar='SEC', type=float,
+                        default=webclient.DEFAULT_TIMEOUT,
+                        help=("HTTP connect/read timeout. Default: %s"
+                              % webclient.DEFAULT_TIMEOUT))
+    parser.add_argument("--http-retries", metavar='N', type=int,
+                        default=webclient.DEFAULT_RETRIES,
+                        help=("Retries for failed HTTP request. Default: %s"
+                              % webclient.DEFAULT_RETRIES))
+    parser.add_argument("--http-pool", metavar='N', type=int, default=None,
+                        help=("Kept-alive connections per host. "
+                              "Default: max(%s, --jobs)"
+                              % webclient.DEFAULT_POOL_SIZE))
+    parser.add_argument("--cache-dir", metavar='DIR', default=None,
+                        help=("Keep HTTP responses in DIR and revalidate "
+                              "them on next runs, DIR must survive between "
+                              "runs. Default: no cache"))
+    parser.add_argument("--max-cache-age", metavar='SEC', type=float,
+                        default=0,
+                        help=("Use cached response without revalidation if "
+                              "it is younger than SEC. Default: 0"))
+    parser.add_argument("--cache-size", metavar='MB', type=int,
+                        default=webclient.DEFAULT_CACHE_SIZE // 2**20,
+                        help=("Cache size limit, least recently used "
+                              "entries are evicted. Default: %s"
+                              % (webclient.DEFAULT_CACHE_SIZE // 2**20)))
+    parser.add_argument("--mirror", metavar='DIR', default=None,
+                        help=("Keep sparse shallow clones of dist-git repos "
+                              "in DIR and read tests from them."))
+    parser.add_argument("--state", metavar='SFILE', default=None,
+                        help="Save state of checked packages to SFILE.")
+    parser.add_argument("--incremental", action='store_true',
+                        help=("Check again only packages changed in "
+                              "dist-git since the run which saved --state."))
+    parser.add_argument("--category", metavar='TITLE=EXPR', action='append',
+                        default=[],
+                        help=("Count packages in extra category. EXPR is "
+                              "comma separated flags, ! negates a flag. "
+                              "Flags: %s. Example: "
+                              "'Tests, not gated=test_yml,!gating_yaml'"
+                              % ', '.join(name for name, _ in pkgrecord.FLAGS)))
+    parser.add_argument("--shard-by", choices=('letter', 'rows'), default=None,
+                        help=("Split every wiki page to index page and "
+                              "sub-pages by first letter or by --shard-rows."))
+    parser.add_argument("--shard-rows", metavar='N', type=int,
+                        default=DEFAULT_SHARD_ROWS,
+                        help=("Packages per sub-page for --shard-by rows. "
+                              "Default: %s" % DEFAULT_SHARD_ROWS))
+    opts = parser.parse_args()
+    categories = []
+    for category in opts.category:
+        title, sep, expr = category.rpartition('=')
+        if not sep or not title:
+            parser.error('Bad --category: %s' % category)
+        try:
+            PkgsStat({}).count_expr(expr)
+        except ValueError as err:
+            parser.error(str(err))
+        categories.append((title, expr))
+    if opts.incremental and not opts.state:
+        parser.error('--incremental requires --state')
+    if opts.shard_rows < 1:
+        parser.error('--shard-rows must be at least 1')
+    for name in ('wikipage', 'purpose'):
+        values = getattr(opts, name)
+        if values and len(values) != len(opts.projects):
+            parser.error('--%s must be given once per --projects' % name)
+    if opts.host_rate is None:
+        opts.host_rate = DEFAULT_HOST_RATE if opts.jobs > 1 else 0
+    rate_limiter.set_rate(opts.host_rate)
+    pool_size = opts.http_pool or max(webclient.DEFAULT_POOL_SIZE, opts.jobs)
+    webclient.configure(pool_size=pool_size, timeout=opts.http_timeout,
+                        retries=opts.http_retries)
+    if opts.cache_dir:
+        print("Use HTTP cache: %s" % opts.cache_dir)
+        webclient.enable_cache(opts.cache_dir, opts.cache_size * 2**20,
+                               opts.max_cache_age)
+    if opts.mirror:
+        global mirror
+        mirror = distgit_mirror.DistGitMirror(opts.mirror, DIST_GIT_URL)
+    pkgs_lists = [read_pkgs_list(fname, opts.short) for fname in opts.projects]
+    # Union of all lists, in order of first appearance.
+    pkgs = list(dict.fromkeys(pkg for pkgs_list in pkgs_lists
+                              for pkg in pkgs_list))
     print("Input projects: %s" % pprint.pformat(pkgs))
-    for pkg in pkgs:
-        print("Checking %s: " % pkg)
-        get_pkg_info(pkg)
+    started = time.time()
+    state = load_state(opts.state) if opts.state else {}
+    known = carry_forward(pkgs, state) if opts.incremental else {}
+    checked = scan_pkgs(pkgs, opts.jobs, known)
+    listed = sum(len(set(pkgs_list)) for pkgs_list in pkgs_lists)
+    if listed > len(pkgs):
+        per_pkg = webclient.request_stats['requests'] / max(1, len(checked))
+        print("Packages in lists: %s, unique: %s. Deduplication avoided "
+              "%s package checks, ~%d HTTP requests."
+              % (listed, len(pkgs), listed - len(pkgs),
+                 (listed - len(pkgs)) * per_pkg))
+    if opts.state:
+        # Carried forward packages are known unchanged up to `started` too,
+        # so the next changes window starts there for all of them.
+        for pkg in pkgs:
+            if pkg in checked:
+                hashes = checked[pkg]
+            else:
+                hashes = state[pkg].get('hashes')
+            if hashes is None:
+                # Some probe failed, check the package again next run.
+                state.pop(pkg, None)
+                continue
+            state[pkg] = {'info': ipkgs[pkg].to_list(), 'checked': started,
+                          'hashes': hashes}
+        print('Save state to: %s' % opts.state)
+        save_state(opts.state, state)
+    print("Existence probes: %(probes)s, bytes not downloaded: %(bytes_saved)s"
+          " (size known for %(sized)s probes)" % webclient.probe_stats)
+    print("Playbooks parsed: %(parsed)s, served from parse cache: %(cached)s"
+          % testtags.cache_stats)
+    cache = webclient.get_cache()
+    if cache:
+        print("HTTP cache: %s" % pprint.pformat(cache.stats))
+        print("HTTP cache: evicted %s entries" % cache.prune())
     # print("Packages information:\n%s" % pprint.pformat(ipkgs))
-    if opts.purpose:
-        print('Set packages list purpose to: %s' % opts.purpose)
-        global purpose
-        purpose = opts.purpose
-    if opts.wikipage:
-        print('Dump wiki page to: %s' % opts.wikipage)
-        page = render_wpage()
-        with open(opts.wikipage, 'w') as wfile:
-            wfile.write(page)
+    for num, pkgs_list in enumerate(pkgs_lists):
+        desc = None
+        if opts.purpose:
+            desc = opts.purpose[num]
+            print('Set packages list purpose to: %s' % desc)
+        if opts.wikipage:
+            print('Dump wiki page to: %s' % opts.wikipage[num])
+            list_pkgs = dict((pkg, ipkgs[pkg]) for pkg in pkgs_list)
+            if opts.shard_by:
+                write_sharded_wpage(opts.wikipage[num], list_pkgs, desc,
+                                    categories, opts.shard_by,
+                                    opts.shard_rows)
+            else:
+                write_wpage(opts.wikipage[num], list_pkgs, desc, categories)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Find test tags (classic, container, atomic) in tests.yml.
+
+Playbooks are parsed as YAML, so commented out tags are not counted.
+Included playbooks and task files are followed recursively, as well as
+tasks of roles found in roles_path. Parsed files are cached by git blob
+hash of their content, the same file shared by many packages is parsed
+once per run. Tags of a local tests directory are memoized by hash of
+the whole tree, see dir_tags().
+
+This is a static replacement of `ansible-playbook --list-tags`.
+"""
+
+import os
+import re
+import hashlib
+import posixpath
+import threading
+import yaml
+
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    STRING_TYPES = (str,)
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+KNOWN_TAGS = ('classic', 'container', 'atomic')
+
+# Keys which include other playbook or tasks file.
+INCLUDE_KEYS = ('include', 'import_playbook', 'include_tasks', 'import_tasks')
+# Keys which run a role.
+ROLE_KEYS = ('include_role', 'import_role')
+# Where roles are looked up when tests are in local directory and ansible
+# is not configured, see default_roles_path(). Relative paths are relative
+# to tests directory.
+ROLES_PATH = ('roles', '/etc/ansible/roles', '/usr/share/ansible/roles')
+# Ansible config files, the first one found is used.
+ANSIBLE_CONFIGS = ('ansible.cfg', '~/.ansible.cfg', '/etc/ansible/ansible.cfg')
+
+_cache_lock = threading.Lock()
+# {blob hash: (tags, includes, roles)}
+_parse_cache = {}
+# {tree hash: tags}
+_tree_cache = {}
+cache_stats = {'parsed': 0, 'cached': 0, 'trees': 0, 'trees_cached': 0}
+
+
+def blob_hash(text):
+    """Git blob hash of text, the same as `git hash-object`."""
+    data = text if isinstance(text, bytes) else text.encode('utf-8')
+    header = ('blob %d\0' % len(data)).encode('ascii')
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def _role_name(role):
+    if isinstance(role, dict):
+        role = role.get('role', role.get('name'))
+    if isinstance(role, STRING_TYPES) and '{{' not in role:
+        return role
+    return None
+
+
+def _walk(node, tags, includes, roles):
+    if isinstance(node, list):
+        for item in node:
+            _walk(item, tags, includes, roles)
+    elif isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'tags':
+                if isinstance(value, STRING_TYPES):
+                    value = re.split(r'[,\s]+', value)
+                elif not isinstance(value, list):
+                    continue
+                tags.update(tag.strip() for tag in value
+                            if isinstance(tag, STRING_TYPES))
+            elif key in INCLUDE_KEYS and isinstance(value, STRING_TYPES):
+                # Old style: "include: file.yml var=value"
+                fname = value.split()[0] if value.split() else ''
+                if fname and '{{' not in fname:
+                    includes.append(fname)
+            elif key in INCLUDE_KEYS and isinstance(value, dict):
+                # "include_tasks: {file: file.yml, apply: {tags: ...}}"
+                fname = value.get('file')
+                if isinstance(fname, STRING_TYPES) and '{{' not in fname:
+                    includes.append(fname)
+                _walk(value, tags, includes, roles)
+            else:
+                if key == 'roles' and isinstance(value, list):
+                    roles.extend(_role_name(role) for role in value)
+                elif key in ROLE_KEYS:
+                    roles.append(_role_name(value))
+                _walk(value, tags, includes, roles)
+
+
+def _parse(text):
+    tags = set()
+    includes = []
+    roles = []
+    try:
+        _walk(yaml.safe_load(text), tags, includes, roles)
+    except yaml.YAMLError:
+        # Broken YAML, look for tags at least in lines not commented out.
+        lines = [line for line in text.splitlines()
+                 if not line.lstrip().startswith('#')]
+        tags.update(re.findall(r'\b(%s)\b' % '|'.join(KNOWN_TAGS),
+                               '\n'.join(lines)))
+    return (frozenset(tags & set(KNOWN_TAGS)), tuple(includes),
+            tuple(role for role in roles if role))
+
+
+def parse_playbook(text):
+    """Tags, includes and roles of a playbook.
+
+    Returns
+    -------
+    tuple
+        (frozenset of KNOWN_TAGS found, tuple of included file names,
+        tuple of role names)
+    """
+    key = blob_hash(text)
+    with _cache_lock:
+        if key in _parse_cache:
+            cache_stats['cached'] += 1
+            return _parse_cache[key]
+    parsed = _parse(text)
+    with _cache_lock:
+        _parse_cache[key] = parsed
+        cache_stats['parsed'] += 1
+    return parsed
+
+
+class TagExtractor(object):
+    """Collects test tags of one package.
+
+    Parameters
+    ----------
+    get_file : function
+        get_file(path) returns content of the file, path is relative to
+        tests/ directory. Returns None if there is no such file.
+    roles_path : tuple
+        Directories with roles. Tasks of used roles are searched for tags
+        too. Empty by default, roles are not followed.
+    """
+
+    def __init__(self, get_file, roles_path=()):
+        self.get_file = get_file
+        self.roles_path = roles_path
+        # Every file is fetched once: {path: content or None}
+        self.files = {}
+
+    def read(self, path):
+        if path not in self.files:
+            self.files[path] = self.get_file(path)
+        return self.files[path]
+
+    def tags(self, path='tests.yml'):
+        """Tags of the playbook and all files it includes.
+
+        Returns
+        -------
+        list
+            Found tags in KNOWN_TAGS order, None if there is no playbook.
+        """
+        if self.read(path) is None:
+            return None
+        found = set()
+        seen = set()
+        todo = [path]
+        while todo:
+            path = todo.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            text = self.read(path)
+            if text is None:
+                continue
+            tags, includes, roles = parse_playbook(text)
+            found.update(tags)
+            base = posixpath.dirname(path)
+            for include in includes:
+                include = posixpath.normpath(posixpath.join(base, include))
+                if not include.startswith('..'):
+                    todo.append(include)
+            for role in roles:
+                for roles_dir in self.roles_path:
+                    tasks = posixpath.join(roles_dir, role, 'tasks', 'main.yml')
+                    if self.read(tasks) is not None:
+                        todo.append(tasks)
+                        break
+        return [tag for tag in KNOWN_TAGS if tag in found]
+
+
+def _read_file(fname):
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'rb') as file_in:
+        return file_in.read().decode('utf-8', 'replace')
+
+
+def tree_hash(path):
+    """Hash of all file names and contents under path."""
+    tree = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            fname = os.path.join(root, fname)
+            if not os.path.isfile(fname):
+                continue
+            with open(fname, 'rb') as file_in:
+                blob = blob_hash(file_in.read())
+            rel = os.path.relpath(fname, path).replace(os.sep, '/')
+            tree.update(('%s %s\n' % (blob, rel)).encode('utf-8'))
+    return tree.hexdigest()
+
+
+def _config_roles_path():
+    """roles_path from ansible config file, None if it is not set."""
+    configs = [os.environ.get('ANSIBLE_CONFIG')] + list(ANSIBLE_CONFIGS)
+    for fname in configs:
+        if not fname:
+            continue
+        fname = os.path.expanduser(fname)
+        if not os.path.isfile(fname):
+            continue
+        config = configparser.RawConfigParser()
+        try:
+            config.read(fname)
+            return config.get('defaults', 'roles_path')
+        except configparser.Error:
+            return None
+    return None
+
+
+def default_roles_path():
+    """Roles path as ansible sees it.
+
+    ANSIBLE_ROLES_PATH goes first, then roles_path from ansible config
+    file (ANSIBLE_CONFIG or the usual locations), ROLES_PATH if neither
+    is set. Local 'roles' directory is looked up first, like ansible does.
+    """
+    value = os.environ.get('ANSIBLE_ROLES_PATH') or _config_roles_path()
+    if not value:
+        return ROLES_PATH
+    dirs = [os.path.expanduser(roles_dir) for roles_dir in value.split(':') if roles_dir]
+    return tuple(['roles'] + [roles_dir for roles_dir in dirs if roles_dir != 'roles'])
+
+
+def dir_tags(path, playbook='tests.yml', roles_path=None):
+    """Tags of playbook in local tests directory.
+
+    Result is memoized by tree_hash() of the directory, the same tests
+    checked again (pull request and build of one package) are not
+    parsed twice.
+
+    Parameters
+    ----------
+    path : str
+        Tests directory.
+    playbook : str
+        Playbook file name, relative to path.
+    roles_path : tuple
+        Directories with roles, relative to path or absolute. Default is
+        default_roles_path().
+
+    Returns
+    -------
+    list
+        Found tags, None if there is no playbook.
+    """
+    if roles_path is None:
+        roles_path = default_roles_path()
+    key = tree_hash(path) + ' ' + playbook
+    with _cache_lock:
+        if key in _tree_cache:
+            cache_stats['trees_cached'] += 1
+            return _tree_cache[key]
+    get_file = lambda fname: _read_file(os.path.join(path, fname))
+    tags = TagExtractor(get_file, roles_path).tags(playbook)
+    with _cache_lock:
+        _tree_cache[key] = tags
+        cache_stats['trees'] += 1
+    return tags
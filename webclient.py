@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2018
+
+"""Purpose: Shared HTTP client for stat.py and fedora_ci tools.
+
+All requests go through one requests.Session. Connections are kept alive
+and pooled per host, so TLS handshake with a host is done once per run,
+not once per request. Failed connections and 5xx answers are retried with
+exponential backoff.
+
+Optional persistent cache stores GET responses on disk. Cached entries
+are revalidated with conditional requests (ETag / Last-Modified), so
+unchanged documents cost only headers transfer.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+_lock = threading.Lock()
+_session = None
+_cache = None
+_stats_lock = threading.Lock()
+# Requests sent over network.
+request_stats = {'requests': 0}
+# Existence probes done and response bytes not downloaded by them. Bytes
+# are known only for probes answered with Content-Length ('sized').
+probe_stats = {'probes': 0, 'sized': 0, 'bytes_saved': 0}
+_settings = {'pool_size': DEFAULT_POOL_SIZE,
+             'timeout': DEFAULT_TIMEOUT,
+             'retries': DEFAULT_RETRIES,
+             'backoff': DEFAULT_BACKOFF}
+
+
+def configure(pool_size=None, timeout=None, retries=None, backoff=None):
+    """Tune HTTP client. Must be called before the first request.
+
+    Parameters
+    ----------
+    pool_size : int
+        Number of kept-alive connections per host. Should be not less
+        than number of threads doing requests at the same time.
+    timeout : float
+        Connect and read timeout in seconds.
+    retries : int
+        How many times to retry failed request.
+    backoff : float
+        Backoff factor, sleep between retries is: backoff * 2^(retry - 1).
+    """
+    global _session
+    with _lock:
+        for key, value in (('pool_size', pool_size), ('timeout', timeout),
+                           ('retries', retries), ('backoff', backoff)):
+            if value is not None:
+                _settings[key] = value
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _new_session():
+    retry = Retry(total=_settings['retries'],
+                  backoff_factor=_settings['backoff'],
+                  status_forcelist=(500, 502, 503, 504),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=_settings['pool_size'],
+                          pool_maxsize=_settings['pool_size'],
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Returns shared requests.Session, creates it on first call."""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = _new_session()
+        return _session
+
+
+def request(method, url, **kwargs):
+    """Send request through shared session.
+
+    Accepts the same arguments as requests.request(). Timeout defaults to
+    configured value.
+
+    Returns
+    -------
+    requests.Response
+    """
+    kwargs.setdefault('timeout', _settings['timeout'])
+    with _stats_lock:
+        request_stats['requests'] += 1
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    """GET request through shared session."""
+    return request('GET', url, **kwargs)
+
+
+def query_text(url, **kwargs):
+    """GET url and return response text.
+
+    TLS certificate is not verified unless verify is passed.
+
+    Returns
+    -------
+    str
+        Response text, None on connection error or non 2xx answer.
+    """
+    kwargs.setdefault('verify', False)
+    try:
+        resp = get(url, **kwargs)
+    except Exception as e:
+        print("FAIL: Could not connect to %s" % url)
+        print("Exception: %s" % e)
+        return None
+    if resp.status_code < 200 or resp.status_code >= 300:
+        return None
+    return resp.text
+
+
+def head(url, **kwargs):
+    """HEAD request through shared session."""
+    return request('HEAD', url, **kwargs)
+
+
+def exists(url, **kwargs):
+    """Checks that url answers 200 without downloading response body.
+
+    Uses HEAD request. If server does not allow HEAD, uses streamed GET
+    which is closed right after headers are received.
+
+    Returns
+    -------
+    bool
+        True if url exists, None if server failed to answer (5xx, 429).
+    """
+    kwargs.setdefault('allow_redirects', True)
+    response = head(url, **kwargs)
+    if response.status_code in (405, 501):
+        response = get(url, stream=True, **kwargs)
+        response.close()
+    try:
+        saved = int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        saved = None
+    with _stats_lock:
+        probe_stats['probes'] += 1
+        if saved is not None:
+            probe_stats['sized'] += 1
+            probe_stats['bytes_saved'] += saved
+    if response.status_code >= 500 or response.status_code == 429:
+        return None
+    return response.status_code == 200
+
+
+class ResponseCache(object):
+    """Persistent cache of GET responses keyed by URL.
+
+    Every entry is two files named by URL hash: <hash>.json with URL,
+    validators and time of last validation, and <hash>.body with raw
+    response body. Access time of body file is used for LRU eviction.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory, created if missing.
+    max_size : int
+        Cache size limit in bytes, enforced by prune().
+    max_age : float
+        Seconds after validation when entry is used without asking the
+        server. 0 means revalidate every time.
+    """
+
+    VALIDATORS = ('ETag', 'Last-Modified')
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE, max_age=0):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.stats = {'fresh': 0, 'revalidated': 0, 'downloaded': 0}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _files(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.path, key)
+        return base + '.json', base + '.body'
+
+    def _write(self, fname, data):
+        # Write to temporary file and rename, so parallel readers never
+        # see half written entry.
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp, fname)
+
+    def count(self, what):
+        with self.lock:
+            self.stats[what] += 1
+
+    def load(self, url):
+        """Returns (meta, body) for url or (None, None) if not cached."""
+        meta_file, body_file = self._files(url)
+        try:
+            with open(meta_file) as meta_in:
+                meta = json.load(meta_in)
+            with open(body_file, 'rb') as body_in:
+                body = body_in.read()
+            os.utime(body_file, None)
+        except (IOError, OSError, ValueError):
+            return None, None
+        if meta.get('url') != url:
+            return None, None
+        return meta, body
+
+    def store(self, url, response):
+        """Save 200 response for url."""
+        meta_file, body_file = self._files(url)
+        headers = dict((name, response.headers[name])
+                       for name in self.VALIDATORS + ('Content-Type',)
+                       if name in response.headers)
+        meta = {'url': url, 'validated': time.time(), 'headers': headers,
+                'encoding': response.encoding}
+        self._write(body_file, response.content)
+        self.refresh(url, meta)
+
+    def refresh(self, url, meta):
+        """Mark entry as just validated."""
+        meta['validated'] = time.time()
+        meta_file, _ = self._files(url)
+        self._write(meta_file, json.dumps(meta).encode('utf-8'))
+
+    def is_fresh(self, meta):
+        return time.time() - meta['validated'] < self.max_age
+
+    def conditional_headers(self, meta):
+        headers = {}
+        if 'ETag' in meta['headers']:
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if 'Last-Modified' in meta['headers']:
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        return headers
+
+    def prune(self):
+        """Evict least recently used entries above size limit.
+
+        Returns
+        -------
+        int
+            Number of evicted entries.
+        """
+        entries = []
+        total = 0
+        for fname in os.listdir(self.path):
+            if not fname.endswith('.body'):
+                continue
+            body_file = os.path.join(self.path, fname)
+            meta_file = body_file[:-len('.body')] + '.json'
+            try:
+                st = os.stat(body_file)
+                size = st.st_size + os.path.getsize(meta_file)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, size, body_file, meta_file))
+            total += size
+        entries.sort()
+        evicted = 0
+        for _, size, body_file, meta_file in entries:
+            if total <= self.max_size:
+                break
+            for fname in (meta_file, body_file):
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+        return evicted
+
+
+def enable_cache(path, max_size=DEFAULT_CACHE_SIZE, max_age=0):
+    """Turn on persistent cache for cached_get().
+
+    Returns
+    -------
+    ResponseCache
+    """
+    global _cache
+    _cache = ResponseCache(path, max_size, max_age)
+    return _cache
+
+
+def get_cache():
+    """Returns enabled ResponseCache or None."""
+    return _cache
+
+
+def _cached_response(url, meta, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(meta['headers'])
+    response.encoding = meta['encoding']
+    response._content = body
+    response.from_cache = True
+    return response
+
+
+def cached_get(url, before_request=None, **kwargs):
+    """GET request served through persistent cache if it is enabled.
+
+    Cached entry is revalidated with the server unless it is younger than
+    max_age. On 304 answer the body is taken from cache.
+
+    Parameters
+    ----------
+    url : str
+        Url to get.
+    before_request : function
+        Called with url right before a request is sent over network, not
+        called when a fresh cached entry is used. E.g. rate limiter.
+
+    Returns
+    -------
+    requests.Response
+    """
+    cache = _cache
+    if cache is None:
+        if before_request is not None:
+            before_request(url)
+        return get(url, **kwargs)
+    meta, body = cache.load(url)
+    if meta is not None:
+        if cache.is_fresh(meta):
+            cache.count('fresh')
+            return _cached_response(url, meta, body)
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.update(cache.conditional_headers(meta))
+        kwargs['headers'] = headers
+    if before_request is not None:
+        before_request(url)
+    response = get(url, **kwargs)
+    if response.status_code == 304 and meta is not None:
+        cache.refresh(url, meta)
+        cache.count('revalidated')
+        return _cached_response(url, meta, body)
+    cache.count('downloaded')
+    if response.status_code == 200:
+        cache.store(url, response)
+    return response